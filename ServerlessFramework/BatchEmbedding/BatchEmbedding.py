@@ -1,40 +1,39 @@
 from typing import Dict, List, Set
-import json
-import boto3
-from botocore.exceptions import ClientError
-import psycopg2
 from openai import OpenAI
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import hashlib
+import json
 import os
-from supabase import create_client
+from hpe_runtime import get_client, get_secret as get_cached_secret, get_supabase_client
+from chunking import chunk_text, get_token_counter, pool_embeddings
+from embedding_batcher import EmbeddingBatcher, EmbeddingInput, EmbeddingResult, pack_batches
+from embedding_cache import CACHE_PATH, DEFAULT_MAX_BYTES, EmbeddingCache
+from embedding_checkpoint import CHECKPOINT_PATH, EmbeddingCheckpoint
+from embedding_writer import EmbeddingRow, write_embeddings
+from pipeline import EMBED_WORKERS, EmbeddingPipeline
+from post_source import FETCH_SIZE, PostPager, iter_posts
+from rate_limiter import DEAD_LETTER_PATH, ResilientEmbedder
+
+BLACK_LIST_PATH = "black_list.txt"
 
 def get_secret():
     secret_name = "SUPABASE_CONNECTION_SECRET"
     region_name = "ap-northeast-1"
-
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=region_name
-    )
-
-    try:
-        get_secret_value_response = client.get_secret_value(
-            SecretId=secret_name
-        )
-    except ClientError as e:
-        raise e
-
-    secret = get_secret_value_response['SecretString']
-    return json.loads(secret)
+    return get_cached_secret(secret_name, region_name=region_name)
 
 def get_target_post(supabase_client, offset, batch_size):
-    data = supabase_client.table("dim_posts").select("post_id, post_content, post_title, rel_post_tags(dim_tags(tag_name))").order('post_id', desc=True).lt("post_id", offset).limit(batch_size).execute()
+    query = supabase_client.table("dim_posts").select("post_id, post_content, post_title, content_embedding_hash, rel_post_tags(dim_tags(tag_name))").order('post_id', desc=True)
+    if offset is not None:
+        query = query.lt("post_id", offset)
+    data = query.limit(batch_size).execute()
     normalized_data = [
         {
             "post_id": post["post_id"], 
             "post_content": post["post_content"],
             "post_title": post["post_title"],
-            "tags": [tag["dim_tags"]["tag_name"] for tag in post["rel_post_tags"]]
+            "tags": [tag["dim_tags"]["tag_name"] for tag in post["rel_post_tags"]],
+            "content_embedding_hash": post["content_embedding_hash"],
         }
         for post in data.data
     ]
@@ -47,54 +46,173 @@ def get_embedding_input_text(post):
     content = post["post_content"]
     return template.format(title=title, tags=tags, content=content)
 
-def get_embedding(post):
-    openAI_client = OpenAI(api_key=os.environ["OPENAI_API_KEY"])
-    try:
-        response = openAI_client.embeddings.create(
-            input = get_embedding_input_text(post),
-            model = "text-embedding-3-small"
-        )
-        ans = {
-            "embedding": response.data[0].embedding,
-            "token_count" : response.usage.total_tokens 
+def get_content_hash(post):
+    # 取得元によってタグの順序が異なるため、タグを並べ替えてからハッシュをとる
+    text = get_embedding_input_text(dict(post, tags=sorted(post["tags"])))
+    return hashlib.md5(text.encode("utf-8")).hexdigest()
+
+def needs_embedding(post):
+    # 埋め込みがない投稿はハッシュもNULLになっている
+    return post["content_embedding_hash"] != get_content_hash(post)
+
+def get_openai_client():
+    # リトライはResilientEmbedderで行う
+    return get_client(("openai", os.environ["OPENAI_API_KEY"]), lambda: OpenAI(api_key=os.environ["OPENAI_API_KEY"], max_retries=0))
+
+def get_embedder():
+    # 同時実行数の調整は、すべてのワーカーで1つの制限を共有する
+    return get_client("embedder", lambda: ResilientEmbedder(EmbeddingBatcher(get_openai_client())))
+
+def get_embeddings(posts, cache=None):
+    # 推定トークン数で投稿を詰め、数百件ずつまとめて埋め込む
+    # 入力上限を超える投稿は段落ごとのチャンクに分け、同じリクエストで埋め込んでから1つのベクトルにまとめる
+    # キャッシュにある入力はAPIを呼ばずに使う
+    embedder = get_embedder()
+    batcher = embedder.batcher
+    count_tokens, max_input_tokens = get_token_counter(batcher.model)
+    inputs = []
+    chunk_counts = {}
+    results = {}
+    for post in posts:
+        chunks = chunk_text(get_embedding_input_text(post), count_tokens, max_input_tokens)
+        chunk_counts[post["post_id"]] = len(chunks)
+        for text, token_count in chunks:
+            cached = cache.get(batcher.model, text) if cache is not None else None
+            if cached is not None:
+                embedding, cached_token_count = cached
+                results.setdefault(post["post_id"], []).append(
+                    (EmbeddingResult(post["post_id"], embedding, cached_token_count), token_count)
+                )
+            else:
+                inputs.append(EmbeddingInput(post["post_id"], text, token_count))
+
+    # 同時に送るリクエスト数はembedder.limiterが調整する
+    batches = list(pack_batches(inputs, batcher.max_tokens, batcher.max_inputs))
+    failed_post_ids = set()
+    with ThreadPoolExecutor(max_workers=embedder.limiter.maximum) as executor:
+        for succeeded, failed in executor.map(embedder.embed, batches):
+            failed_post_ids.update(item.post_id for item in failed)
+            for item, result in succeeded:
+                results.setdefault(result.post_id, []).append((result, item.estimated_tokens))
+            if cache is not None:
+                cache.put_many(batcher.model, [
+                    (item.text, result.embedding, result.token_count)
+                    for item, result in succeeded
+                ])
+
+    embeddings = {}
+    for post_id, chunk_results in results.items():
+        # チャンクの一部でも失敗した投稿は書き込まない（デッドレターから再実行する）
+        if post_id in failed_post_ids or len(chunk_results) != chunk_counts[post_id]:
+            continue
+        embeddings[post_id] = {
+            "embedding": pool_embeddings(
+                [result.embedding for result, _ in chunk_results],
+                [weight for _, weight in chunk_results],
+            ),
+            "token_count": sum(result.token_count for result, _ in chunk_results),
         }
-        return ans
-    except Exception as e:
-        with open("black_list.txt", "a") as f:
-            f.write(f"{post['post_id']}\n")
-        print(e)
+    chunked = sum(1 for count in chunk_counts.values() if count > 1)
+    print(f"Embedded {len(embeddings)} posts ({chunked} chunked, {len(failed_post_ids)} failed) in {batcher.request_count} requests, "
+          f"{embedder.retries} retries, concurrency {embedder.limiter.limit:.1f}")
+    if cache is not None:
+        print(f"Embedding cache: {cache.stats()}")
+    return embeddings
+
+def update_embeddings(posts, embeddings):
+    rows = [
+        EmbeddingRow(post["post_id"], embedding["embedding"], embedding["token_count"], get_content_hash(post))
+        for post in posts
+        if (embedding := embeddings.get(post["post_id"])) is not None
+    ]
+    if not rows:
+        return
+    # 書き込みに失敗した場合はチェックポイントを進めずに止める
+    stats = write_embeddings(rows)
+    print(f"Updated {stats.rows} posts in {stats.seconds:.2f}s ({stats.rows_per_second:.0f} rows/s)")
+
+def run(mode, checkpoint, cache=None, batch_size=1000, embed_workers=EMBED_WORKERS, source="postgres", fetch_size=FETCH_SIZE):
+    # 次のページの取得と書き込みを、埋め込みと並行して行う
+    # postgresでは差分実行の対象をSQLで絞り込む。needs_embeddingは、取得した投稿に対する最後の確認として残す
+    if source == "postgres":
+        fetch_page = PostPager(batch_size, fetch_size, only_stale=mode == "incremental")
+    else:
+        # PostgRESTではハッシュを比べられないため、すべての投稿を取得して絞り込む
+        supabase_client = get_supabase_client(get_secret())
+        fetch_page = lambda offset: get_target_post(supabase_client, offset, batch_size)
+    pipeline = EmbeddingPipeline(
+        fetch_page=fetch_page,
+        select_targets=lambda posts: posts if mode == "full" else [post for post in posts if needs_embedding(post)],
+        embed=lambda posts: get_embeddings(posts, cache),
+        write=update_embeddings,
+        checkpoint=checkpoint,
+        embed_workers=embed_workers,
+    )
+    pipeline.run()
+
+def load_replay_post_ids(paths):
+    # black_list.txtは1行に1つのpost_id、デッドレターはJSON Lines
+    post_ids = {}
+    for path in paths:
+        try:
+            with open(path) as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    post_id = json.loads(line)["post_id"] if line.startswith("{") else int(line)
+                    post_ids[post_id] = None
+        except FileNotFoundError:
+            pass
+    return list(post_ids)
+
+def replay(cache=None, paths=(BLACK_LIST_PATH, DEAD_LETTER_PATH)):
+    # 再実行中に失敗した投稿はデッドレターに記録し直されるため、元のファイルは処理が終わってから消す
+    replaying_paths = []
+    for path in paths:
+        if os.path.exists(path):
+            os.replace(path, f"{path}.replaying")
+        if os.path.exists(f"{path}.replaying"):
+            replaying_paths.append(f"{path}.replaying")
+    post_ids = load_replay_post_ids(replaying_paths)
+    print(f"Replaying {len(post_ids)} posts")
+    for i in range(0, len(post_ids), 1000):
+        posts = list(iter_posts(post_ids=post_ids[i:i + 1000]))
+        update_embeddings(posts, get_embeddings(posts, cache))
+    for path in replaying_paths:
+        os.remove(path)
+
+def main():
+    parser = argparse.ArgumentParser(description="dim_postsの埋め込みを作成する")
+    parser.add_argument("--mode", choices=["full", "incremental"], default="incremental",
+                        help="incremental: 埋め込みがない、または入力テキストが変わった投稿だけを処理する"
+                             "（初回はsql/content_embedding_hash.sqlで既存の投稿のハッシュを埋めておく）")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH)
+    parser.add_argument("--reset", action="store_true", help="チェックポイントを無視して最新の投稿から処理する")
+    parser.add_argument("--cache", default=CACHE_PATH, help="埋め込みのキャッシュのディレクトリ")
+    parser.add_argument("--cache-max-mb", type=int, default=DEFAULT_MAX_BYTES // 1024 ** 2)
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("--replay", action="store_true", help="black_list.txtとデッドレターの投稿だけを再実行する")
+    parser.add_argument("--source", choices=["postgres", "postgrest"], default="postgres",
+                        help="postgres: サーバーサイドカーソルで直接読む / postgrest: Supabaseのクライアントでページごとに読む")
+    parser.add_argument("--fetch-size", type=int, default=FETCH_SIZE, help="サーバーサイドカーソルから一度に受け取る行数")
+    parser.add_argument("--embed-workers", type=int, default=EMBED_WORKERS, help="埋め込みを並行して行うスレッド数")
+    args = parser.parse_args()
+
+    cache = None if args.no_cache else EmbeddingCache(args.cache, args.cache_max_mb * 1024 ** 2)
+    checkpoint = EmbeddingCheckpoint(args.checkpoint, args.mode)
+    if args.reset:
+        checkpoint.clear()
 
-def update_embeddings(posts, embeddings, supabase_client):
     try:
-        updates = [
-            {"post_id": post["post_id"], "content_embedding": embedding["embedding"], "token_count": embedding["token_count"]}
-            for post, embedding in zip(posts, embeddings)
-        ]
-
-        for update in updates:
-            print(f"Updating post {update['post_id']}")
-            supabase_client.table("dim_posts").update(update).eq("post_id", update["post_id"]).execute()
-    except Exception as e:
-        print(e)
-
-def process_posts_in_batches(posts, batch_size, supabase_client):
-    for i in range(0, len(posts), batch_size):
-        batch = posts[i:i + batch_size]
-        embeddings = [get_embedding(post) for post in batch]
-        update_embeddings(batch, embeddings, supabase_client)
-    min_post_id = min([post["post_id"] for post in posts])
-    max_post_id = max([post["post_id"] for post in posts])
-    print(f"Finished processing posts from {min_post_id} to {max_post_id}")
-    return min_post_id
-
-secrets = get_secret()
-supabase_url = secrets["SUPABASE_URL"]
-supabase_service_role_key = secrets["SUPABASE_SERVICE_ROLE_KEY"]
-supabase_client = create_client(supabase_url, supabase_service_role_key)
-
-post_count = supabase_client.table("dim_posts").select("post_id", count="exact").execute().count
-batch_size = 1000
-min_post_id = 26864
-for i in range(0, post_count, batch_size):
-    posts = get_target_post(supabase_client, min_post_id, batch_size)
-    min_post_id = process_posts_in_batches(posts, 100, supabase_client)
+        if args.replay:
+            replay(cache)
+        else:
+            run(args.mode, checkpoint, cache, embed_workers=args.embed_workers, source=args.source, fetch_size=args.fetch_size)
+    finally:
+        # 参照の記録を索引に書き出す
+        if cache is not None:
+            cache.close()
+
+if __name__ == "__main__":
+    main()
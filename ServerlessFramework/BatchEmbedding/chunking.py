@@ -0,0 +1,98 @@
+"""
+モデルの入力上限を超える長い投稿の分割とプーリング
+
+- トークン数はtiktokenがあれば正確に数え、なければembedding_batcher.estimate_tokensで見積もる
+- 上限を超える入力は段落（HTMLのブロック要素の終わりや空行）の境目で分割し、
+  1段落が上限を超える場合は文の終わり、それでも超える場合は文字数で分割する
+- チャンクごとのベクトルはトークン数で重み付けして平均し、L2ノルムで正規化して1つのベクトルにする
+"""
+import math
+import re
+from typing import Callable, Final, List, Sequence, Tuple
+
+from embedding_batcher import EMBEDDING_MODEL, estimate_tokens
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+# text-embedding-3-smallの入力上限は8191トークン
+MAX_INPUT_TOKENS: Final[int] = 8000
+# 見積もりの場合、漢字は1文字で複数トークンになることがあるため余裕を持たせる
+MAX_ESTIMATED_INPUT_TOKENS: Final[int] = 4000
+# 1文字あたりの最大トークン数の目安（文字数で分割する場合に使う）
+MAX_TOKENS_PER_CHAR: Final[int] = 3
+
+BLOCK_BOUNDARY_PATTERN: Final[re.Pattern] = re.compile(
+    r"</(?:p|h[1-6]|li|ul|ol|table|div|blockquote|pre)>|<br\s*/?>|\n\s*\n",
+    re.IGNORECASE,
+)
+SENTENCE_BOUNDARY_PATTERN: Final[re.Pattern] = re.compile(r"[。！？!?]|\n")
+
+
+def get_token_counter(model: str = EMBEDDING_MODEL) -> Tuple[Callable[[str], int], int]:
+    # (トークン数を数える関数, 1入力あたりの上限)
+    if tiktoken is None:
+        return estimate_tokens, MAX_ESTIMATED_INPUT_TOKENS
+    encoding = tiktoken.encoding_for_model(model)
+    return (lambda text: len(encoding.encode(text, disallowed_special=()))), MAX_INPUT_TOKENS
+
+
+def split_after(pattern: re.Pattern, text: str) -> List[str]:
+    # 区切りは前の部分に含める
+    pieces = []
+    start = 0
+    for match in pattern.finditer(text):
+        if match.end() > start:
+            pieces.append(text[start:match.end()])
+            start = match.end()
+    if start < len(text):
+        pieces.append(text[start:])
+    return pieces
+
+
+def split_piece(piece: str, count_tokens: Callable[[str], int], max_tokens: int) -> List[str]:
+    if count_tokens(piece) <= max_tokens:
+        return [piece]
+    sentences = split_after(SENTENCE_BOUNDARY_PATTERN, piece)
+    if len(sentences) > 1:
+        return [part for sentence in sentences for part in split_piece(sentence, count_tokens, max_tokens)]
+    width = max(1, max_tokens // MAX_TOKENS_PER_CHAR)
+    return [piece[i:i + width] for i in range(0, len(piece), width)]
+
+
+def chunk_text(text: str, count_tokens: Callable[[str], int], max_tokens: int) -> List[Tuple[str, int]]:
+    # [(チャンク, トークン数)]。上限に収まる入力はそのまま1つのチャンクにする
+    token_count = count_tokens(text)
+    if token_count <= max_tokens:
+        return [(text, token_count)]
+
+    chunks: List[Tuple[str, int]] = []
+    current: List[str] = []
+    current_tokens = 0
+    for block in split_after(BLOCK_BOUNDARY_PATTERN, text):
+        for piece in split_piece(block, count_tokens, max_tokens):
+            piece_tokens = count_tokens(piece)
+            if current and current_tokens + piece_tokens > max_tokens:
+                chunks.append(("".join(current), current_tokens))
+                current = []
+                current_tokens = 0
+            current.append(piece)
+            current_tokens += piece_tokens
+    if current:
+        chunks.append(("".join(current), current_tokens))
+    return chunks
+
+
+def pool_embeddings(embeddings: Sequence[Sequence[float]], weights: Sequence[int]) -> List[float]:
+    if len(embeddings) == 1:
+        return list(embeddings[0])
+    total_weight = sum(weights) or 1
+    pooled = [
+        sum(weight * values[i] for values, weight in zip(embeddings, weights)) / total_weight
+        for i in range(len(embeddings[0]))
+    ]
+    norm = math.sqrt(sum(value * value for value in pooled)) or 1.0
+    return [value / norm for value in pooled]
@@ -0,0 +1,90 @@
+"""
+埋め込みAPIへのリクエストをまとめる
+
+embeddings.createは入力の配列を受け付けるため、推定トークン数と入力数の上限に収まるように投稿を詰めて1リクエストで送る。
+返ってきたベクトルはdata[i].indexで投稿に対応付け、usage.total_tokensは推定トークン数の比で各投稿に割り振る。
+"""
+from typing import Dict, Final, Iterable, Iterator, List, Mapping, NamedTuple, Tuple
+
+
+EMBEDDING_MODEL: Final[str] = "text-embedding-3-small"
+# 1リクエストあたりの上限（APIの上限は入力2048件・合計30万トークン程度なので余裕を持たせる）
+MAX_BATCH_TOKENS: Final[int] = 100_000
+MAX_BATCH_INPUTS: Final[int] = 512
+
+
+class EmbeddingInput(NamedTuple):
+    post_id: int
+    text: str
+    estimated_tokens: int
+
+
+class EmbeddingResult(NamedTuple):
+    post_id: int
+    embedding: List[float]
+    token_count: int
+
+
+def estimate_tokens(text: str) -> int:
+    # 日本語はおおむね1文字1トークン、英数字は4文字で1トークンとして多めに見積もる
+    ascii_count = sum(1 for char in text if char.isascii())
+    return (len(text) - ascii_count) + ascii_count // 4 + 1
+
+
+def pack_batches(
+    inputs: Iterable[EmbeddingInput],
+    max_tokens: int = MAX_BATCH_TOKENS,
+    max_inputs: int = MAX_BATCH_INPUTS,
+) -> Iterator[List[EmbeddingInput]]:
+    batch: List[EmbeddingInput] = []
+    batch_tokens = 0
+    for item in inputs:
+        if batch and (batch_tokens + item.estimated_tokens > max_tokens or len(batch) >= max_inputs):
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append(item)
+        batch_tokens += item.estimated_tokens
+    if batch:
+        yield batch
+
+
+def apportion_tokens(total_tokens: int, weights: List[int]) -> List[int]:
+    # 合計がtotal_tokensと一致するように、端数は最後の入力に寄せる
+    weight_sum = sum(weights) or 1
+    counts = [total_tokens * weight // weight_sum for weight in weights]
+    if counts:
+        counts[-1] += total_tokens - sum(counts)
+    return counts
+
+
+class EmbeddingBatcher:
+    def __init__(self, client, model: str = EMBEDDING_MODEL,
+                 max_tokens: int = MAX_BATCH_TOKENS, max_inputs: int = MAX_BATCH_INPUTS):
+        self.client = client
+        self.model = model
+        self.max_tokens = max_tokens
+        self.max_inputs = max_inputs
+        self.request_count = 0
+
+    def embed_batch(self, batch: List[EmbeddingInput]) -> List[EmbeddingResult]:
+        return self.embed_batch_with_headers(batch)[0]
+
+    def embed_batch_with_headers(self, batch: List[EmbeddingInput]) -> Tuple[List[EmbeddingResult], Mapping[str, str]]:
+        # レート制限のヘッダー（x-ratelimit-*）も返す
+        raw_response = self.client.embeddings.with_raw_response.create(
+            input=[item.text for item in batch],
+            model=self.model,
+        )
+        response = raw_response.parse()
+        self.request_count += 1
+        embeddings: Dict[int, List[float]] = {data.index: data.embedding for data in response.data}
+        token_counts = apportion_tokens(
+            response.usage.total_tokens,
+            [item.estimated_tokens for item in batch],
+        )
+        results = [
+            EmbeddingResult(item.post_id, embeddings[i], token_count)
+            for i, (item, token_count) in enumerate(zip(batch, token_counts))
+        ]
+        return results, raw_response.headers
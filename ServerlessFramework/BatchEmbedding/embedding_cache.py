@@ -0,0 +1,307 @@
+"""
+ディスク上の埋め込みのキャッシュ（標準ライブラリのみ）
+
+- キーは sha256(モデル名 + "\\0" + 入力テキスト)。テンプレートの出力が同じなら再度APIを呼ばない
+- ベクトルはfloat32の追記専用ファイル（vectors.f32）にためてmmapで読み、
+  索引（index.bin）には (キー, 行番号, トークン数) の固定長レコードを追記する
+- 参照したキーも索引に追記し、次回の読み込みで最近使った順序を復元する
+- 合計サイズがmax_bytesを超えたら、最近使っていない順に捨てて詰め直す（compact）
+  詰め直したファイルは次の世代の名前で書き、meta.jsonの世代を置き換えた時点で切り替える
+  （途中で落ちても、古い索引と新しいベクトルが組み合わさることはない）
+- JSON Linesで書き出し・読み込みができる
+
+python ServerlessFramework/BatchEmbedding/embedding_cache.py export --cache tmp/embedding_cache --output tmp/embeddings.jsonl
+python ServerlessFramework/BatchEmbedding/embedding_cache.py import --cache tmp/embedding_cache --input tmp/embeddings.jsonl
+"""
+import argparse
+import glob
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Dict, Final, Iterable, List, Optional, Tuple
+
+
+CACHE_PATH: Final[str] = "./tmp/embedding_cache"
+DEFAULT_MAX_BYTES: Final[int] = 2 * 1024 ** 3
+INDEX_RECORD: Final[struct.Struct] = struct.Struct("<32sQI")
+FLOAT_SIZE: Final[int] = 4
+# 参照の記録をこの件数ためたら索引に追記する
+TOUCH_FLUSH_COUNT: Final[int] = 1024
+
+
+def cache_key(model: str, text: str) -> bytes:
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).digest()
+
+
+class EmbeddingCache:
+    def __init__(self, path: str = CACHE_PATH, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+        self._meta_path = os.path.join(path, "meta.json")
+        self.dimensions: Optional[int] = None
+        self.generation = 0
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path) as f:
+                meta = json.load(f)
+            self.dimensions = meta["dimensions"]
+            self.generation = meta.get("generation", 0)
+        # キー -> (行番号, トークン数)。最近使ったものほど後ろにある
+        self._entries: "OrderedDict[bytes, Tuple[int, int]]" = OrderedDict()
+        # 索引にまだ書いていない参照（古いものほど前にある）
+        self._touched: "OrderedDict[bytes, None]" = OrderedDict()
+        self._row_count = 0
+        self._mmap: Optional[mmap.mmap] = None
+        # 複数のスレッドから使えるようにする
+        self._lock = threading.RLock()
+        self._load_index()
+
+    def _data_paths(self, generation: int) -> Tuple[str, str]:
+        # 世代0は、世代を導入する前のファイル名
+        suffix = "" if generation == 0 else f".{generation}"
+        return os.path.join(self.path, f"vectors{suffix}.f32"), os.path.join(self.path, f"index{suffix}.bin")
+
+    @property
+    def _vectors_path(self) -> str:
+        return self._data_paths(self.generation)[0]
+
+    @property
+    def _index_path(self) -> str:
+        return self._data_paths(self.generation)[1]
+
+    def _write_meta(self, dimensions: int, generation: int) -> None:
+        tmp_path = f"{self._meta_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"dimensions": dimensions, "generation": generation}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._meta_path)
+
+    @property
+    def row_bytes(self) -> int:
+        return (self.dimensions or 0) * FLOAT_SIZE
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _load_index(self) -> None:
+        if self.dimensions is None or not os.path.exists(self._index_path):
+            return
+        self._row_count = os.path.getsize(self._vectors_path) // self.row_bytes
+        with open(self._index_path, "rb") as f:
+            data = f.read()
+        # 書き込みの途中で落ちた場合、末尾の不完全なレコードや、ベクトルがない行は無視する
+        # 同じキーのレコードは参照の記録なので、後ろにあるものほど最近使ったことになる
+        record_count = 0
+        for offset in range(0, len(data) - INDEX_RECORD.size + 1, INDEX_RECORD.size):
+            key, row, token_count = INDEX_RECORD.unpack_from(data, offset)
+            record_count += 1
+            if row < self._row_count:
+                self._entries[key] = (row, token_count)
+                self._entries.move_to_end(key)
+        self._remove_stale_files()
+        # 参照の記録で索引が膨らんだら、現在の順序で書き直す
+        if record_count > 2 * len(self._entries):
+            self._rewrite_index()
+
+    def _remove_stale_files(self) -> None:
+        # 詰め直しの途中で落ちた場合などに残る、現在の世代ではないファイル
+        current = set(self._data_paths(self.generation))
+        candidates = glob.glob(os.path.join(self.path, "vectors*.f32")) + glob.glob(os.path.join(self.path, "index*.bin"))
+        for file_path in candidates + glob.glob(os.path.join(self.path, "*.tmp")):
+            if file_path not in current:
+                os.remove(file_path)
+
+    def _rewrite_index(self) -> None:
+        # 行番号は変わらないため、索引だけを置き換えればよい
+        tmp_path = f"{self._index_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(b"".join(INDEX_RECORD.pack(key, row, token_count) for key, (row, token_count) in self._entries.items()))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._index_path)
+        self._touched.clear()
+
+    def _flush_touches(self) -> None:
+        records = [
+            INDEX_RECORD.pack(key, *self._entries[key])
+            for key in self._touched
+            if key in self._entries
+        ]
+        self._touched.clear()
+        if records:
+            with open(self._index_path, "ab") as index_file:
+                index_file.write(b"".join(records))
+
+    def _view(self) -> Optional[mmap.mmap]:
+        size = self._row_count * self.row_bytes
+        if size == 0:
+            return None
+        if self._mmap is None or len(self._mmap) < size:
+            self._close_view()
+            with open(self._vectors_path, "rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush_touches()
+            self._close_view()
+
+    def _close_view(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def get(self, model: str, text: str) -> Optional[Tuple[List[float], int]]:
+        key = cache_key(model, text)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            self._touch(key)
+            return self._read_row(entry[0]), entry[1]
+
+    def _touch(self, key: bytes) -> None:
+        self._touched[key] = None
+        self._touched.move_to_end(key)
+        if len(self._touched) >= TOUCH_FLUSH_COUNT:
+            self._flush_touches()
+
+    def _read_row(self, row: int) -> List[float]:
+        view = self._view()
+        start = row * self.row_bytes
+        vector = array("f")
+        vector.frombytes(view[start:start + self.row_bytes])
+        return vector.tolist()
+
+    def put(self, model: str, text: str, embedding: List[float], token_count: int) -> None:
+        self.put_many(model, [(text, embedding, token_count)])
+
+    def put_many(self, model: str, items: Iterable[Tuple[str, List[float], int]]) -> None:
+        self._put_keys((cache_key(model, text), embedding, token_count) for text, embedding, token_count in items)
+
+    def _put_keys(self, items: Iterable[Tuple[bytes, List[float], int]]) -> None:
+        with self._lock:
+            self._put_keys_locked(items)
+
+    def _put_keys_locked(self, items: Iterable[Tuple[bytes, List[float], int]]) -> None:
+        # ベクトルを書いてから索引を書く（索引だけが残ることはない）
+        new_entries = []
+        with open(self._vectors_path, "ab") as vectors_file:
+            for key, embedding, token_count in items:
+                if self.dimensions is None:
+                    self.dimensions = len(embedding)
+                    self._write_meta(self.dimensions, self.generation)
+                if len(embedding) != self.dimensions:
+                    raise ValueError(f"embedding has {len(embedding)} dimensions, cache has {self.dimensions}")
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    self._touched[key] = None
+                    self._touched.move_to_end(key)
+                    continue
+                vectors_file.write(array("f", embedding).tobytes())
+                new_entries.append((key, self._row_count, token_count))
+                self._entries[key] = (self._row_count, token_count)
+                self._row_count += 1
+        self._flush_touches()
+        if new_entries:
+            with open(self._index_path, "ab") as index_file:
+                index_file.write(b"".join(INDEX_RECORD.pack(*entry) for entry in new_entries))
+
+        if self.size_bytes() > self.max_bytes:
+            self.compact()
+
+    def size_bytes(self) -> int:
+        return self._row_count * (self.row_bytes + INDEX_RECORD.size)
+
+    def compact(self, max_bytes: Optional[int] = None) -> int:
+        # 最近使ったものから、max_bytesの9割に収まるだけ残して書き直す。捨てた件数を返す
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        keep_count = min(len(self._entries), int(max_bytes * 0.9) // (self.row_bytes + INDEX_RECORD.size))
+        kept = list(self._entries.items())[len(self._entries) - keep_count:]
+        dropped = len(self._entries) - keep_count
+
+        # 次の世代のファイルに書き、meta.jsonの世代を置き換えた時点で切り替える
+        generation = self.generation + 1
+        vectors_path, index_path = self._data_paths(generation)
+        entries: "OrderedDict[bytes, Tuple[int, int]]" = OrderedDict()
+        with open(vectors_path, "wb") as vectors_file, open(index_path, "wb") as index_file:
+            for new_row, (key, (row, token_count)) in enumerate(kept):
+                start = row * self.row_bytes
+                vectors_file.write(self._view()[start:start + self.row_bytes])
+                index_file.write(INDEX_RECORD.pack(key, new_row, token_count))
+                entries[key] = (new_row, token_count)
+            for f in [vectors_file, index_file]:
+                f.flush()
+                os.fsync(f.fileno())
+        self._close_view()
+        if self.dimensions is not None:
+            self._write_meta(self.dimensions, generation)
+        old_paths = self._data_paths(self.generation)
+        self.generation = generation
+        self._entries = entries
+        self._row_count = len(entries)
+        self._touched.clear()
+        for file_path in old_paths:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        return dropped
+
+    def export_jsonl(self, path: str) -> int:
+        count = 0
+        with open(path, "w") as f:
+            for key, (row, token_count) in self._entries.items():
+                f.write(json.dumps({
+                    "key": key.hex(),
+                    "embedding": self._read_row(row),
+                    "token_count": token_count,
+                }) + "\n")
+                count += 1
+        return count
+
+    def import_jsonl(self, path: str) -> int:
+        with open(path) as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        self._put_keys(
+            (bytes.fromhex(record["key"]), record["embedding"], record["token_count"])
+            for record in records
+        )
+        return len(records)
+
+    def stats(self) -> Dict[str, int]:
+        return {"entries": len(self), "bytes": self.size_bytes(), "hits": self.hits, "misses": self.misses}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="埋め込みのキャッシュの管理")
+    parser.add_argument("command", choices=["stats", "export", "import", "compact"])
+    parser.add_argument("--cache", default=CACHE_PATH)
+    parser.add_argument("--output", help="exportの出力先（JSON Lines）")
+    parser.add_argument("--input", help="importするファイル（JSON Lines）")
+    parser.add_argument("--max-mb", type=int, default=DEFAULT_MAX_BYTES // 1024 ** 2)
+    args = parser.parse_args()
+
+    cache = EmbeddingCache(args.cache, args.max_mb * 1024 ** 2)
+    if args.command == "export":
+        print(f"Exported {cache.export_jsonl(args.output)} embeddings to {args.output}")
+    elif args.command == "import":
+        print(f"Imported {cache.import_jsonl(args.input)} embeddings from {args.input}")
+    elif args.command == "compact":
+        print(f"Dropped {cache.compact()} embeddings")
+    print(cache.stats())
+    cache.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""
+BatchEmbeddingのチェックポイント
+
+post_idの降順に処理し、書き込みまで終わったページの最小のpost_idを保存する。
+一時ファイルに書いてから置き換えるため、途中で落ちても壊れたチェックポイントは残らない。
+"""
+import datetime
+import json
+import os
+from typing import Final, Optional
+
+
+CHECKPOINT_PATH: Final[str] = "./tmp/embedding_checkpoint.json"
+
+
+class EmbeddingCheckpoint:
+    def __init__(self, path: str, mode: str):
+        self.path = path
+        self.mode = mode
+
+    def load(self) -> Optional[int]:
+        # 別のモードで保存されたチェックポイントは使わない
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        if data.get("mode") != self.mode:
+            print(f"checkpoint {self.path} is for {data.get('mode')} mode. ignored.")
+            return None
+        return data["last_post_id"]
+
+    def save(self, last_post_id: int) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({
+                "mode": self.mode,
+                "last_post_id": last_post_id,
+                "updated_at": datetime.datetime.now().isoformat(),
+            }, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def clear(self) -> None:
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,92 @@
+"""
+埋め込みをdim_postsへまとめて書き込む
+
+PostgRESTで1件ずつupdateする代わりに、psycopg2のCOPYで一時テーブルへ流し込み、UPDATE ... FROMの1文で反映する。
+接続先は環境変数SUPABASE_DB_URL、なければDLT_CONNECTION_PARAMSのconnection_stringを使う。
+"""
+import io
+import os
+import time
+from typing import Final, Iterable, NamedTuple
+
+import psycopg2
+from hpe_runtime import get_secret
+
+
+STAGING_TABLE_SQL: Final[str] = """
+CREATE TEMP TABLE embedding_updates (
+    post_id bigint PRIMARY KEY,
+    content_embedding text NOT NULL,
+    token_count integer NOT NULL,
+    content_embedding_hash text NOT NULL
+) ON COMMIT DROP
+"""
+
+UPDATE_FROM_STAGING_SQL: Final[str] = """
+UPDATE dim_posts
+SET content_embedding = embedding_updates.content_embedding::vector,
+    token_count = embedding_updates.token_count,
+    content_embedding_hash = embedding_updates.content_embedding_hash
+FROM embedding_updates
+WHERE dim_posts.post_id = embedding_updates.post_id
+"""
+
+
+class EmbeddingRow(NamedTuple):
+    post_id: int
+    content_embedding: Iterable[float]
+    token_count: int
+    content_embedding_hash: str
+
+
+class WriteStats(NamedTuple):
+    rows: int
+    seconds: float
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds > 0 else 0.0
+
+
+def get_dsn() -> str:
+    dsn = os.environ.get("SUPABASE_DB_URL")
+    if dsn:
+        return dsn
+    # SQLAlchemy向けの接続文字列（postgresql+psycopg2://...）もそのまま使えるようにする
+    return get_secret("DLT_CONNECTION_PARAMS", region_name="ap-northeast-1")["connection_string"].replace("+psycopg2", "", 1)
+
+
+_connection = None
+
+
+def get_connection():
+    global _connection
+    if _connection is None or _connection.closed:
+        _connection = psycopg2.connect(get_dsn())
+    return _connection
+
+
+def to_copy_buffer(rows: Iterable[EmbeddingRow]) -> io.StringIO:
+    # COPYのテキスト形式（タブ区切り）。ベクトルはpgvectorの'[x,y,...]'表記にする
+    buffer = io.StringIO()
+    for row in rows:
+        vector = "[" + ",".join(repr(float(value)) for value in row.content_embedding) + "]"
+        buffer.write(f"{int(row.post_id)}\t{vector}\t{int(row.token_count)}\t{row.content_embedding_hash}\n")
+    buffer.seek(0)
+    return buffer
+
+
+def write_embeddings(rows: Iterable[EmbeddingRow], connection=None) -> WriteStats:
+    connection = connection or get_connection()
+    start = time.perf_counter()
+    buffer = to_copy_buffer(rows)
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute(STAGING_TABLE_SQL)
+            cursor.copy_expert(
+                "COPY embedding_updates (post_id, content_embedding, token_count, content_embedding_hash) FROM STDIN",
+                buffer,
+            )
+            cursor.execute(UPDATE_FROM_STAGING_SQL)
+            updated = cursor.rowcount
+    return WriteStats(updated, time.perf_counter() - start)
@@ -0,0 +1,185 @@
+"""
+BatchEmbeddingの取得・埋め込み・書き込みのパイプライン
+
+- 取得（1スレッド）→ 埋め込み（embed_workersスレッド）→ 書き込み（1スレッド）を上限付きのキューでつなぐ
+  キューが埋まると前の段階が待つため、取得が先に進みすぎることはない
+- 埋め込みの間に次のページを先読みし、書き込みも並行して行う
+- チェックポイントは、それより前のページがすべて書き込み済みになった最後のページまでしか進めない
+- 段階ごとに処理件数と所要時間を集計する
+"""
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Final, List, NamedTuple, Optional
+
+
+QUEUE_SIZE: Final[int] = 2
+EMBED_WORKERS: Final[int] = 2
+POLL_SECONDS: Final[float] = 0.5
+
+
+class Page(NamedTuple):
+    seq: int
+    posts: List[Dict]
+    targets: List[Dict]
+
+
+class EmbeddedPage(NamedTuple):
+    page: Page
+    embeddings: Dict[int, Any]
+
+
+class StageStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.batches = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, items: int, seconds: float) -> None:
+        with self._lock:
+            self.items += items
+            self.batches += 1
+            self.seconds += seconds
+
+    def __str__(self) -> str:
+        rate = self.items / self.seconds if self.seconds > 0 else 0.0
+        return f"{self.name}: {self.items} posts in {self.batches} batches, busy {self.seconds:.1f}s ({rate:.1f} posts/s)"
+
+
+class _Stopped(Exception):
+    pass
+
+
+class EmbeddingPipeline:
+    def __init__(
+        self,
+        fetch_page: Callable[[Optional[int]], List[Dict]],
+        select_targets: Callable[[List[Dict]], List[Dict]],
+        embed: Callable[[List[Dict]], Dict[int, Any]],
+        write: Callable[[List[Dict], Dict[int, Any]], None],
+        checkpoint,
+        embed_workers: int = EMBED_WORKERS,
+        queue_size: int = QUEUE_SIZE,
+    ):
+        self.fetch_page = fetch_page
+        self.select_targets = select_targets
+        self.embed = embed
+        self.write = write
+        self.checkpoint = checkpoint
+        self.embed_workers = embed_workers
+        self._pages: "queue.Queue[Optional[Page]]" = queue.Queue(queue_size)
+        self._embedded: "queue.Queue[Optional[EmbeddedPage]]" = queue.Queue(queue_size)
+        self._stop = threading.Event()
+        self._errors: List[BaseException] = []
+        self.stats = {name: StageStats(name) for name in ["fetch", "embed", "write"]}
+
+    def _put(self, q: queue.Queue, item) -> None:
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=POLL_SECONDS)
+                return
+            except queue.Full:
+                continue
+        raise _Stopped()
+
+    def _get(self, q: queue.Queue):
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                continue
+        raise _Stopped()
+
+    def _close(self, q: queue.Queue, count: int) -> None:
+        # 後ろの段階に終わりを知らせる。停止中は知らせる必要がない
+        try:
+            for _ in range(count):
+                self._put(q, None)
+        except _Stopped:
+            pass
+
+    def _run_stage(self, target: Callable[[], None]) -> None:
+        try:
+            target()
+        except _Stopped:
+            pass
+        except BaseException as e:
+            self._errors.append(e)
+            self._stop.set()
+
+    def _fetch(self, offset: Optional[int]) -> None:
+        seq = 0
+        try:
+            while True:
+                start = time.perf_counter()
+                posts = self.fetch_page(offset)
+                if not posts:
+                    break
+                targets = self.select_targets(posts)
+                self.stats["fetch"].add(len(posts), time.perf_counter() - start)
+                self._put(self._pages, Page(seq, posts, targets))
+                offset = min(post["post_id"] for post in posts)
+                seq += 1
+        finally:
+            self._close(self._pages, self.embed_workers)
+
+    def _embed(self) -> None:
+        try:
+            while True:
+                page = self._get(self._pages)
+                if page is None:
+                    break
+                start = time.perf_counter()
+                embeddings = self.embed(page.targets) if page.targets else {}
+                self.stats["embed"].add(len(page.targets), time.perf_counter() - start)
+                self._put(self._embedded, EmbeddedPage(page, embeddings))
+        finally:
+            self._close(self._embedded, 1)
+
+    def _write(self) -> None:
+        finished_workers = 0
+        next_seq = 0
+        # 書き込み済みだが、前のページが終わっていないためチェックポイントに反映できないページ
+        completed: Dict[int, Page] = {}
+        while finished_workers < self.embed_workers:
+            embedded = self._get(self._embedded)
+            if embedded is None:
+                finished_workers += 1
+                continue
+            start = time.perf_counter()
+            self.write(embedded.page.targets, embedded.embeddings)
+            self.stats["write"].add(len(embedded.embeddings), time.perf_counter() - start)
+
+            completed[embedded.page.seq] = embedded.page
+            while next_seq in completed:
+                page = completed.pop(next_seq)
+                last_post_id = min(post["post_id"] for post in page.posts)
+                self.checkpoint.save(last_post_id)
+                print(f"Finished processing posts from {last_post_id} to {max(post['post_id'] for post in page.posts)} ({len(page.targets)} targets)")
+                next_seq += 1
+            print(" / ".join(str(stats) for stats in self.stats.values()))
+
+    def run(self) -> None:
+        offset = self.checkpoint.load()
+        if offset is not None:
+            print(f"Resuming from post_id < {offset}")
+        threads = [threading.Thread(target=self._run_stage, args=(lambda: self._fetch(offset),), name="fetch")]
+        threads += [
+            threading.Thread(target=self._run_stage, args=(self._embed,), name=f"embed-{i}")
+            for i in range(self.embed_workers)
+        ]
+        threads.append(threading.Thread(target=self._run_stage, args=(self._write,), name="write"))
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for stats in self.stats.values():
+            print(stats)
+        print(f"Elapsed {time.perf_counter() - start:.1f}s")
+        if self._errors:
+            raise self._errors[0]
+        self.checkpoint.clear()
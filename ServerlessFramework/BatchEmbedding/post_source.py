@@ -0,0 +1,86 @@
+"""
+dim_postsを直接Postgresから読み出す
+
+PostgRESTでページごとにrel_post_tags(dim_tags(tag_name))を結合して取得する代わりに、
+タグ名を投稿ごとに集約する1つのSQLを名前付き（サーバーサイド）カーソルで実行し、fetch_size件ずつ受け取る。
+書き込み側のコミットでカーソルが閉じないよう、読み出し専用の別の接続を使う。
+差分実行では、埋め込みがない投稿と入力テキストのハッシュが変わった投稿だけをSQLで絞り込み、変わっていない投稿の本文は転送しない。
+"""
+import itertools
+from typing import Dict, Final, Iterator, List, Optional, Sequence
+
+import psycopg2
+
+from embedding_writer import get_dsn
+
+
+FETCH_SIZE: Final[int] = 500
+
+POSTS_SQL: Final[str] = """
+SELECT p.post_id, p.post_content, p.post_title, p.content_embedding_hash,
+       COALESCE(array_agg(t.tag_name ORDER BY t.tag_name) FILTER (WHERE t.tag_name IS NOT NULL), '{{}}') AS tags
+FROM dim_posts AS p
+LEFT JOIN rel_post_tags AS r ON r.post_id = p.post_id
+LEFT JOIN dim_tags AS t ON t.tag_id = r.tag_id
+{where}
+GROUP BY p.post_id
+{having}
+ORDER BY p.post_id DESC
+"""
+
+# BatchEmbedding.get_content_hashと同じ入力テキストのmd5と比べる（sql/content_embedding_hash.sqlと同じ組み立て方）
+STALE_CONDITION: Final[str] = """
+HAVING p.content_embedding IS NULL
+    OR p.content_embedding_hash IS NULL
+    OR p.content_embedding_hash <> md5(
+        'タイトル: ' || coalesce(p.post_title, 'None')
+        || E'\\nタグ: ' || coalesce(string_agg(t.tag_name, ', ' ORDER BY t.tag_name COLLATE "C"), '')
+        || E'\\n本文: ' || coalesce(p.post_content, 'None')
+    )
+"""
+
+
+def iter_posts(before_post_id: Optional[int] = None, post_ids: Optional[Sequence[int]] = None,
+               fetch_size: int = FETCH_SIZE, only_stale: bool = False) -> Iterator[Dict]:
+    # post_idの降順に1件ずつ返す。メモリに載るのはfetch_size件まで
+    # only_staleの場合は、埋め込みの再計算が必要な投稿だけを返す
+    conditions: List[str] = []
+    params: Dict = {}
+    if before_post_id is not None:
+        conditions.append("p.post_id < %(before_post_id)s")
+        params["before_post_id"] = before_post_id
+    if post_ids is not None:
+        conditions.append("p.post_id = ANY(%(post_ids)s)")
+        params["post_ids"] = list(post_ids)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    connection = psycopg2.connect(get_dsn())
+    try:
+        connection.set_session(readonly=True)
+        with connection.cursor(name="batch_embedding_posts") as cursor:
+            cursor.itersize = fetch_size
+            cursor.execute(POSTS_SQL.format(where=where, having=STALE_CONDITION if only_stale else ""), params)
+            for post_id, post_content, post_title, content_embedding_hash, tags in cursor:
+                yield {
+                    "post_id": post_id,
+                    "post_content": post_content,
+                    "post_title": post_title,
+                    "tags": tags,
+                    "content_embedding_hash": content_embedding_hash,
+                }
+    finally:
+        connection.close()
+
+
+class PostPager:
+    # EmbeddingPipelineのfetch_pageとして使う。最初の呼び出しのoffsetからカーソルを開き、以降は続きを返す
+    def __init__(self, page_size: int, fetch_size: int = FETCH_SIZE, only_stale: bool = False):
+        self.page_size = page_size
+        self.fetch_size = fetch_size
+        self.only_stale = only_stale
+        self._posts: Optional[Iterator[Dict]] = None
+
+    def __call__(self, offset: Optional[int]) -> List[Dict]:
+        if self._posts is None:
+            self._posts = iter_posts(before_post_id=offset, fetch_size=self.fetch_size, only_stale=self.only_stale)
+        return list(itertools.islice(self._posts, self.page_size))
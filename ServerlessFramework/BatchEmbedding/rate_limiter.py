@@ -0,0 +1,192 @@
+"""
+埋め込みAPIの同時実行数の調整とリトライ
+
+- 同時に送るリクエスト数をAIMDで調整する（成功するたびに少しずつ増やし、429が返ったら半分にする）
+- レスポンスのx-ratelimit-remaining-*が尽きそうな場合は、x-ratelimit-reset-*まで新しいリクエストを止める
+- 429・タイムアウト・接続エラー・5xxは、ジッター付きの指数バックオフでリトライする
+- それ以外のエラーはバッチを半分に分けて再実行し、単独でも失敗する入力だけをデッドレターに記録する
+"""
+import datetime
+import json
+import os
+import random
+import re
+import threading
+import time
+from typing import Dict, Final, List, Mapping, Optional, Tuple
+
+import openai
+
+from embedding_batcher import EmbeddingBatcher, EmbeddingInput, EmbeddingResult
+
+
+DEAD_LETTER_PATH: Final[str] = "./tmp/embedding_dead_letters.jsonl"
+MAX_ATTEMPTS: Final[int] = 6
+BASE_DELAY_SECONDS: Final[float] = 1.0
+MAX_DELAY_SECONDS: Final[float] = 60.0
+DURATION_PATTERN: Final[re.Pattern] = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+DURATION_UNITS: Final[Dict[str, float]] = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+class FatalEmbeddingError(Exception):
+    # 残高不足など、リトライしても回復しないためジョブを止めるべきエラー
+    pass
+
+
+class EmbeddingRequestFailed(Exception):
+    def __init__(self, error: Exception, kind: str, attempts: int):
+        super().__init__(str(error))
+        self.error = error
+        self.kind = kind
+        self.attempts = attempts
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    # "20ms", "1s", "6m0s" のような形式を秒に変換する
+    if not value:
+        return None
+    matches = DURATION_PATTERN.findall(value)
+    if not matches:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(number) * DURATION_UNITS[unit] for number, unit in matches)
+
+
+def classify_error(error: Exception) -> str:
+    # "throttled" / "transient" / "permanent" / "fatal"
+    if isinstance(error, openai.RateLimitError):
+        if getattr(error, "code", None) == "insufficient_quota":
+            return "fatal"
+        return "throttled"
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError, TimeoutError, ConnectionError)):
+        return "transient"
+    if isinstance(error, openai.APIStatusError) and error.status_code >= 500:
+        return "transient"
+    if isinstance(error, openai.AuthenticationError):
+        return "fatal"
+    return "permanent"
+
+
+class AdaptiveConcurrencyLimiter:
+    def __init__(self, initial: int = 4, minimum: int = 1, maximum: int = 32):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(initial)
+        self.in_flight = 0
+        self._paused_until = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self) -> None:
+        with self._condition:
+            while True:
+                wait = self._paused_until - time.monotonic()
+                if wait <= 0 and self.in_flight < int(self.limit):
+                    break
+                self._condition.wait(timeout=wait if wait > 0 else None)
+            self.in_flight += 1
+
+    def release(self, outcome: str = "success") -> None:
+        # outcome: "success" / "throttled" / "error"
+        with self._condition:
+            self.in_flight -= 1
+            if outcome == "throttled":
+                self.limit = max(float(self.minimum), self.limit / 2)
+            elif outcome == "success":
+                # 1往復（limit回の成功）でおよそ1増える
+                self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    def pause(self, seconds: float) -> None:
+        with self._condition:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def observe_headers(self, headers: Mapping[str, str], next_tokens: int) -> None:
+        # 次のリクエストを送る余裕がなければ、制限がリセットされるまで止める
+        remaining_requests = headers.get("x-ratelimit-remaining-requests")
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        if remaining_requests is not None and int(remaining_requests) <= 0:
+            self.pause(parse_duration(headers.get("x-ratelimit-reset-requests")) or 1.0)
+        if remaining_tokens is not None and int(remaining_tokens) < next_tokens:
+            self.pause(parse_duration(headers.get("x-ratelimit-reset-tokens")) or 1.0)
+
+
+class DeadLetterQueue:
+    def __init__(self, path: str = DEAD_LETTER_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def record(self, item: EmbeddingInput, error: Exception, attempts: int) -> None:
+        print(f"post_id: {item.post_id} is failed to embed. ({type(error).__name__}: {error})")
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a") as f:
+                f.write(json.dumps({
+                    "post_id": item.post_id,
+                    "estimated_tokens": item.estimated_tokens,
+                    "error_type": type(error).__name__,
+                    "status_code": getattr(error, "status_code", None),
+                    "error": str(error),
+                    "attempts": attempts,
+                    "failed_at": datetime.datetime.now().isoformat(),
+                }, ensure_ascii=False) + "\n")
+
+
+class ResilientEmbedder:
+    def __init__(self, batcher: EmbeddingBatcher, limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+                 dead_letters: Optional[DeadLetterQueue] = None, max_attempts: int = MAX_ATTEMPTS):
+        self.batcher = batcher
+        self.limiter = limiter or AdaptiveConcurrencyLimiter()
+        self.dead_letters = dead_letters or DeadLetterQueue()
+        self.max_attempts = max_attempts
+        self.retries = 0
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        # サーバーが待ち時間を指定していればそれに従い、なければフルジッターの指数バックオフ
+        response = getattr(error, "response", None)
+        if response is not None:
+            retry_after = parse_duration(response.headers.get("retry-after")) \
+                or parse_duration(response.headers.get("x-ratelimit-reset-requests"))
+            if retry_after:
+                return min(MAX_DELAY_SECONDS, retry_after + random.uniform(0, 1))
+        return random.uniform(0, min(MAX_DELAY_SECONDS, BASE_DELAY_SECONDS * 2 ** attempt))
+
+    def _embed_with_retry(self, batch: List[EmbeddingInput]) -> List[EmbeddingResult]:
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            try:
+                results, headers = self.batcher.embed_batch_with_headers(batch)
+            except Exception as e:
+                kind = classify_error(e)
+                self.limiter.release("throttled" if kind == "throttled" else "error")
+                if kind == "fatal":
+                    raise FatalEmbeddingError(str(e)) from e
+                attempt += 1
+                if kind == "permanent" or attempt >= self.max_attempts:
+                    raise EmbeddingRequestFailed(e, kind, attempt) from e
+                delay = self._backoff(attempt, e)
+                if kind == "throttled":
+                    self.limiter.pause(delay)
+                self.retries += 1
+                time.sleep(delay)
+                continue
+            self.limiter.release()
+            self.limiter.observe_headers(headers, sum(item.estimated_tokens for item in batch))
+            return results
+
+    def embed(self, batch: List[EmbeddingInput]) -> Tuple[List[Tuple[EmbeddingInput, EmbeddingResult]], List[EmbeddingInput]]:
+        # (成功した入力と結果, 失敗した入力)
+        try:
+            return list(zip(batch, self._embed_with_retry(batch))), []
+        except EmbeddingRequestFailed as e:
+            if len(batch) == 1 or e.kind != "permanent":
+                for item in batch:
+                    self.dead_letters.record(item, e.error, e.attempts)
+                return [], list(batch)
+        # どの入力が原因かわからないため、半分に分けて再実行する
+        middle = len(batch) // 2
+        first_results, first_failed = self.embed(batch[:middle])
+        second_results, second_failed = self.embed(batch[middle:])
+        return first_results + second_results, first_failed + second_failed
@@ -0,0 +1,29 @@
+-- BatchEmbeddingの差分実行のための定義
+-- Supabaseのダッシュボード（SQL Editor）で実行する
+
+-- 埋め込みを作成したときの入力テキスト（タイトル・タグ・本文）のmd5
+-- 埋め込みがない、またはこの値が現在の入力テキストと異なる投稿だけを再計算する
+alter table dim_posts add column if not exists content_embedding_hash text;
+
+-- 既に埋め込みがある投稿のハッシュを一度だけ埋める（埋めないと最初の差分実行で全件を再計算することになる）
+-- BatchEmbedding.get_content_hashと同じ入力テキストを組み立てる
+--   - タグはPythonのsorted()と同じコードポイント順に並べる（UTF-8ではCの照合順序が一致する）
+--   - タグがない場合は空文字列、値がNULLの場合はPythonのformatと同じく'None'になる
+-- ハッシュを埋めた後に本文やタグが変わっていた投稿は、埋め込みが古いままになる。
+-- 最近変わった投稿がある場合は、その投稿だけ --replay などで再計算する
+update dim_posts as p
+set content_embedding_hash = md5(
+  'タイトル: ' || coalesce(p.post_title, 'None')
+  || E'\nタグ: ' || coalesce(t.tags, '')
+  || E'\n本文: ' || coalesce(p.post_content, 'None')
+)
+from (
+  select d.post_id, string_agg(dt.tag_name, ', ' order by dt.tag_name collate "C") as tags
+  from dim_posts as d
+  left join rel_post_tags as r on r.post_id = d.post_id
+  left join dim_tags as dt on dt.tag_id = r.tag_id
+  where d.content_embedding is not null
+    and d.content_embedding_hash is null
+  group by d.post_id
+) as t
+where p.post_id = t.post_id;
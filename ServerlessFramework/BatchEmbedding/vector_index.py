@@ -0,0 +1,230 @@
+"""
+dim_posts.content_embeddingのベクトルインデックス
+
+- ベクトルは正規化してfloat16、またはint8（行ごとのスケール付き）の連続した行列として.npyに保存し、
+  numpy.loadのmmap_modeでメモリマップして読み込む
+- 検索は複数のクエリをまとめて行列積で計算し、argpartitionで上位k件を取り出す（コサイン類似度）
+- --clustersを指定すると、k-meansで粗いクラスタに分けておき、クエリに近いnprobe個のクラスタだけを検索する
+  クエリをクラスタごとにまとめ、クラスタごとに1回の行列積で、そのクラスタを検索するすべてのクエリの類似度を計算する
+- numpyはLambdaのレイヤーにもrequirements.txtにも含めていないため、ローカルでのみ使う（別途pip install numpyが必要）
+
+python ServerlessFramework/BatchEmbedding/vector_index.py build --output tmp/post_index --dtype int8 --clusters 64
+python ServerlessFramework/BatchEmbedding/vector_index.py query --index tmp/post_index --post-id 26864 -k 10
+"""
+import argparse
+import json
+import os
+import time
+from typing import Dict, Final, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+
+DTYPES: Final[List[str]] = ["float16", "int8"]
+KMEANS_ITERATIONS: Final[int] = 20
+SEARCH_BLOCK_ROWS: Final[int] = 65536
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def quantize(vectors: np.ndarray, dtype: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    if dtype == "float16":
+        return vectors.astype(np.float16), None
+    # 行ごとに最大の絶対値が127になるようにスケールする
+    scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127.0
+    quantized = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+
+def kmeans(vectors: np.ndarray, cluster_count: int, seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    # 正規化済みのベクトルに対する球面k-means。(中心, 各ベクトルの所属)を返す
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), cluster_count, replace=False)].copy()
+    assignments = np.zeros(len(vectors), dtype=np.int32)
+    for _ in range(KMEANS_ITERATIONS):
+        assignments = np.argmax(vectors @ centroids.T, axis=1).astype(np.int32)
+        for cluster in range(cluster_count):
+            members = vectors[assignments == cluster]
+            if len(members):
+                centroids[cluster] = members.mean(axis=0)
+        centroids = normalize(centroids)
+    return centroids, assignments
+
+
+def build_index(post_ids: Iterable[int], vectors: np.ndarray, path: str,
+                dtype: str = "int8", cluster_count: int = 0) -> None:
+    os.makedirs(path, exist_ok=True)
+    post_ids = np.asarray(list(post_ids), dtype=np.int64)
+    vectors = normalize(vectors)
+    meta: Dict = {"dtype": dtype, "count": len(post_ids), "dimensions": int(vectors.shape[1]), "clusters": 0}
+
+    if cluster_count > 0:
+        # 同じクラスタの行が連続するように並べ替え、クラスタごとの開始位置を保存する
+        centroids, assignments = kmeans(vectors, min(cluster_count, len(vectors)))
+        order = np.argsort(assignments, kind="stable")
+        post_ids, vectors, assignments = post_ids[order], vectors[order], assignments[order]
+        offsets = np.searchsorted(assignments, np.arange(len(centroids) + 1)).astype(np.int64)
+        np.save(os.path.join(path, "centroids.npy"), centroids.astype(np.float32))
+        np.save(os.path.join(path, "offsets.npy"), offsets)
+        meta["clusters"] = len(centroids)
+
+    matrix, scales = quantize(vectors, dtype)
+    np.save(os.path.join(path, "vectors.npy"), matrix)
+    np.save(os.path.join(path, "post_ids.npy"), post_ids)
+    if scales is not None:
+        np.save(os.path.join(path, "scales.npy"), scales)
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+
+class VectorIndex:
+    def __init__(self, path: str):
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        self.post_ids = np.load(os.path.join(path, "post_ids.npy"))
+        self.scales = np.load(os.path.join(path, "scales.npy")) if self.meta["dtype"] == "int8" else None
+        self.centroids = None
+        self.offsets = None
+        if self.meta["clusters"]:
+            self.centroids = np.load(os.path.join(path, "centroids.npy"))
+            self.offsets = np.load(os.path.join(path, "offsets.npy"))
+        self._positions = {int(post_id): i for i, post_id in enumerate(self.post_ids)}
+
+    def __len__(self) -> int:
+        return len(self.post_ids)
+
+    def vector(self, post_id: int) -> np.ndarray:
+        position = self._positions[post_id]
+        vector = self.vectors[position].astype(np.float32)
+        if self.scales is not None:
+            vector *= self.scales[position]
+        return vector
+
+    def _scores(self, queries: np.ndarray, start: int, end: int) -> np.ndarray:
+        # 行列をブロックごとにfloat32へ戻して行列積をとる
+        scores = np.empty((len(queries), end - start), dtype=np.float32)
+        for block_start in range(start, end, SEARCH_BLOCK_ROWS):
+            block_end = min(end, block_start + SEARCH_BLOCK_ROWS)
+            block = np.asarray(self.vectors[block_start:block_end], dtype=np.float32)
+            block_scores = queries @ block.T
+            if self.scales is not None:
+                block_scores *= self.scales[block_start:block_end]
+            scores[:, block_start - start:block_end - start] = block_scores
+        return scores
+
+    def _probes(self, queries: np.ndarray, nprobe: int) -> Dict[int, np.ndarray]:
+        # クラスタごとに、そのクラスタを検索するクエリの番号を返す
+        nearest = np.argsort(-(queries @ self.centroids.T), axis=1)[:, :nprobe]
+        return {
+            int(cluster): np.flatnonzero((nearest == cluster).any(axis=1))
+            for cluster in np.unique(nearest)
+        }
+
+    def search(self, queries: np.ndarray, k: int = 10, nprobe: int = 8) -> List[List[Tuple[int, float]]]:
+        # queries: (クエリ数, 次元)。クエリごとに[(post_id, 類似度)]を類似度の高い順に返す
+        queries = normalize(np.atleast_2d(queries))
+        if self.centroids is None:
+            return [self._top_k(scores, 0, k) for scores in self._scores(queries, 0, len(self))]
+
+        merged: List[List[Tuple[int, float]]] = [[] for _ in range(len(queries))]
+        for cluster, query_indexes in self._probes(queries, nprobe).items():
+            start, end = int(self.offsets[cluster]), int(self.offsets[cluster + 1])
+            if end <= start:
+                continue
+            for query_index, scores in zip(query_indexes, self._scores(queries[query_indexes], start, end)):
+                merged[query_index].extend(self._top_k(scores, start, k))
+        results = []
+        for candidates in merged:
+            candidates.sort(key=lambda item: -item[1])
+            results.append(candidates[:k])
+        return results
+
+    def _top_k(self, scores: np.ndarray, start: int, k: int) -> List[Tuple[int, float]]:
+        count = min(len(scores), k)
+        if count == 0:
+            return []
+        top = np.argpartition(-scores, count - 1)[:count]
+        top = top[np.argsort(-scores[top])]
+        return [(int(self.post_ids[start + i]), float(scores[i])) for i in top]
+
+    def related_posts(self, post_ids: List[int], k: int = 10, nprobe: int = 8) -> Dict[int, List[Tuple[int, float]]]:
+        queries = np.stack([self.vector(post_id) for post_id in post_ids])
+        # 自分自身が含まれるため1件多く検索する
+        results = self.search(queries, k + 1, nprobe)
+        return {
+            post_id: [result for result in result_list if result[0] != post_id][:k]
+            for post_id, result_list in zip(post_ids, results)
+        }
+
+
+def parse_vector(value) -> List[float]:
+    # pgvectorの値はテキスト（'[0.1,0.2,...]'）で返ってくる
+    if isinstance(value, str):
+        return json.loads(value)
+    return list(value)
+
+
+def fetch_embeddings(page_size: int = 2000) -> Tuple[List[int], np.ndarray]:
+    from embedding_writer import get_connection
+
+    connection = get_connection()
+    post_ids: List[int] = []
+    vectors: List[List[float]] = []
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT post_id, content_embedding::text FROM dim_posts"
+            " WHERE content_embedding IS NOT NULL ORDER BY post_id"
+        )
+        while True:
+            rows = cursor.fetchmany(page_size)
+            if not rows:
+                break
+            for post_id, embedding in rows:
+                post_ids.append(post_id)
+                vectors.append(parse_vector(embedding))
+    connection.rollback()
+    return post_ids, np.asarray(vectors, dtype=np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="dim_postsの埋め込みのベクトルインデックス")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="dim_postsからインデックスを作成する")
+    build_parser.add_argument("--output", required=True)
+    build_parser.add_argument("--dtype", choices=DTYPES, default="int8")
+    build_parser.add_argument("--clusters", type=int, default=0, help="k-meansのクラスタ数（0で全件を検索する）")
+
+    query_parser = subparsers.add_parser("query", help="投稿に近い投稿を検索する")
+    query_parser.add_argument("--index", required=True)
+    query_parser.add_argument("--post-id", type=int, nargs="+", required=True)
+    query_parser.add_argument("-k", type=int, default=10)
+    query_parser.add_argument("--nprobe", type=int, default=8)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        start = time.perf_counter()
+        post_ids, vectors = fetch_embeddings()
+        print(f"Fetched {len(post_ids)} embeddings in {time.perf_counter() - start:.1f}s")
+        start = time.perf_counter()
+        build_index(post_ids, vectors, args.output, args.dtype, args.clusters)
+        print(f"Built {args.dtype} index at {args.output} in {time.perf_counter() - start:.1f}s")
+    else:
+        index = VectorIndex(args.index)
+        start = time.perf_counter()
+        related = index.related_posts(args.post_id, args.k, args.nprobe)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        for post_id, results in related.items():
+            print(f"post_id: {post_id}")
+            for related_post_id, score in results:
+                print(f"  {related_post_id}\t{score:.4f}")
+        print(f"{len(args.post_id)} queries in {elapsed_ms:.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
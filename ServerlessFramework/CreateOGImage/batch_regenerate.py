@@ -0,0 +1,343 @@
+"""
+OG画像の一括再生成
+
+- dim_postsはpost_idのキーセットページングで取得する（次のページは処理中に先読みする）
+- HTMLのパースと画像の描画（CPUバウンド）はプロセスプールで並列に行う
+- S3へのアップロード（I/Oバウンド）はスレッドプールで並列に行う
+- ページの処理が終わるたびにチェックポイントを保存し、中断しても続きから再開できる
+- 失敗した投稿はJSON Linesの失敗台帳に記録し、--replayで再実行できる
+- 投稿ごとのフィンガープリントをマニフェストに保存し、変化のない投稿は描画・アップロードを省略する
+"""
+import argparse
+import datetime
+import json
+import os
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import Dict, Final, Iterator, List, Optional, Tuple
+
+from hpe_runtime import get_supabase_client
+from supabase import Client
+
+from lambda_function import (
+    compute_fingerprint,
+    get_image,
+    get_supabase_secret,
+    get_text_data,
+    get_uploaded_fingerprint,
+    upload_to_s3,
+)
+
+
+PAGE_SIZE: Final[int] = 200
+UPLOAD_WORKERS: Final[int] = 16
+CHECKPOINT_PATH: Final[str] = "./tmp/og_regenerate_checkpoint.json"
+FAILURE_LEDGER_PATH: Final[str] = "./tmp/og_regenerate_failures.jsonl"
+MANIFEST_PATH: Final[str] = "./tmp/og_fingerprints.json"
+
+
+def write_json_atomically(path: str, data: Dict) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+class Checkpoint:
+    def __init__(self, path: str, start_id: int, end_id: int):
+        self.path = path
+        self.start_id = start_id
+        self.end_id = end_id
+
+    def load(self) -> Optional[int]:
+        # 対象範囲が異なるチェックポイントは使わない
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        if data.get("start_id") != self.start_id or data.get("end_id") != self.end_id:
+            print(f"checkpoint {self.path} is for another range. ignored.")
+            return None
+        return data["last_post_id"]
+
+    def save(self, last_post_id: int) -> None:
+        write_json_atomically(self.path, {
+            "start_id": self.start_id,
+            "end_id": self.end_id,
+            "last_post_id": last_post_id,
+            "updated_at": datetime.datetime.now().isoformat(),
+        })
+
+    def clear(self) -> None:
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class FailureLedger:
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def record(self, post_id: int, stage: str, error: Exception) -> None:
+        print(f"post_id: {post_id} is failed to create OG Image. ({stage}: {error})")
+        with open(self.path, "a") as f:
+            f.write(json.dumps({
+                "post_id": post_id,
+                "stage": stage,
+                "error_type": type(error).__name__,
+                "error": str(error),
+                "failed_at": datetime.datetime.now().isoformat(),
+            }, ensure_ascii=False) + "\n")
+
+    def load_post_ids(self, path: Optional[str] = None) -> List[int]:
+        post_ids: Dict[int, None] = {}
+        try:
+            with open(path or self.path) as f:
+                for line in f:
+                    if line.strip():
+                        post_ids[json.loads(line)["post_id"]] = None
+        except FileNotFoundError:
+            pass
+        return list(post_ids)
+
+
+class FingerprintManifest:
+    # post_id -> アップロード済み画像のフィンガープリント
+    def __init__(self, path: str):
+        self.path = path
+        try:
+            with open(path) as f:
+                self.fingerprints: Dict[str, str] = json.load(f)
+        except FileNotFoundError:
+            self.fingerprints = {}
+
+    def get(self, post_id: int) -> Optional[str]:
+        return self.fingerprints.get(str(post_id))
+
+    def set(self, post_id: int, fingerprint: str) -> None:
+        self.fingerprints[str(post_id)] = fingerprint
+
+    def save(self) -> None:
+        write_json_atomically(self.path, self.fingerprints)
+
+
+def render_post(post: Dict, known_fingerprint: Optional[str], check_remote: bool) -> Tuple[int, str, Optional[bytes]]:
+    # プロセスプールのワーカーで実行される。フォントや下地画像はワーカーごとにキャッシュされる
+    # フィンガープリントが一致した場合は描画せずにNoneを返す
+    post_id = post["post_id"]
+    table_data = get_text_data(post["post_content"])
+    fingerprint = compute_fingerprint(table_data, post["post_title"])
+    if known_fingerprint is None and check_remote:
+        known_fingerprint = get_uploaded_fingerprint(post_id)
+    if known_fingerprint == fingerprint:
+        return post_id, fingerprint, None
+    return post_id, fingerprint, get_image(table_data=table_data, post_id=post_id)
+
+
+def iter_post_pages(
+    client: Client, start_id: int, end_id: int, after_post_id: Optional[int], page_size: int
+) -> Iterator[List[Dict]]:
+    last_post_id = after_post_id
+    while True:
+        query = client.table("dim_posts").select("post_id,post_content,post_title").lte("post_id", end_id)
+        if last_post_id is None:
+            query = query.gte("post_id", start_id)
+        else:
+            query = query.gt("post_id", last_post_id)
+        posts = query.order("post_id").limit(page_size).execute().data
+        if not posts:
+            return
+        yield posts
+        last_post_id = posts[-1]["post_id"]
+        if len(posts) < page_size:
+            return
+
+
+def iter_posts_by_ids(client: Client, post_ids: List[int], page_size: int) -> Iterator[List[Dict]]:
+    for i in range(0, len(post_ids), page_size):
+        posts = client.table("dim_posts").select("post_id,post_content,post_title")\
+            .in_("post_id", post_ids[i:i + page_size])\
+            .order("post_id")\
+            .execute()
+        if posts.data:
+            yield posts.data
+
+
+def process_page(
+    posts: List[Dict],
+    render_executor: ProcessPoolExecutor,
+    upload_executor: ThreadPoolExecutor,
+    ledger: FailureLedger,
+    manifest: FingerprintManifest,
+    check_remote: bool,
+    force: bool = False,
+) -> Tuple[int, int, int]:
+    # forceの場合はマニフェストのフィンガープリントと比べずに描画する（マニフェストは書き換えるだけで消さない）
+    render_futures: Dict[Future, int] = {
+        render_executor.submit(render_post, post, None if force else manifest.get(post["post_id"]), check_remote): post["post_id"]
+        for post in posts
+    }
+    upload_futures: Dict[Future, Tuple[int, str]] = {}
+    skipped = 0
+    failed = 0
+    # 描画が終わったものから順にアップロードを開始する
+    for future in as_completed(render_futures):
+        post_id = render_futures[future]
+        try:
+            _, fingerprint, image_bytes = future.result()
+        except Exception as e:
+            ledger.record(post_id, "render", e)
+            failed += 1
+            continue
+        if image_bytes is None:
+            manifest.set(post_id, fingerprint)
+            skipped += 1
+            continue
+        upload_future = upload_executor.submit(
+            upload_to_s3, post_id=post_id, image_bytes=image_bytes, fingerprint=fingerprint
+        )
+        upload_futures[upload_future] = (post_id, fingerprint)
+
+    succeeded = 0
+    for future in as_completed(upload_futures):
+        post_id, fingerprint = upload_futures[future]
+        try:
+            future.result()
+            manifest.set(post_id, fingerprint)
+            succeeded += 1
+        except Exception as e:
+            ledger.record(post_id, "upload", e)
+            failed += 1
+    return succeeded, skipped, failed
+
+
+def run_pages(
+    pages: Iterator[List[Dict]],
+    ledger: FailureLedger,
+    manifest: FingerprintManifest,
+    check_remote: bool,
+    render_workers: Optional[int],
+    upload_workers: int,
+    checkpoint: Optional[Checkpoint] = None,
+    force: bool = False,
+) -> Tuple[int, int, int]:
+    total_succeeded = 0
+    total_skipped = 0
+    total_failed = 0
+    with ProcessPoolExecutor(max_workers=render_workers) as render_executor, \
+            ThreadPoolExecutor(max_workers=upload_workers) as upload_executor, \
+            ThreadPoolExecutor(max_workers=1) as fetch_executor:
+        next_page = fetch_executor.submit(next, pages, None)
+        batch_id = 0
+        while True:
+            posts = next_page.result()
+            if posts is None:
+                break
+            # 現在のページを処理している間に次のページを取得しておく
+            next_page = fetch_executor.submit(next, pages, None)
+            print(f"batch {batch_id} is processing... Count: {len(posts)}, Min ID: {posts[0]['post_id']}, Max ID: {posts[-1]['post_id']}")
+            succeeded, skipped, failed = process_page(
+                posts, render_executor, upload_executor, ledger, manifest, check_remote, force
+            )
+            total_succeeded += succeeded
+            total_skipped += skipped
+            total_failed += failed
+            # マニフェストを先に保存し、チェックポイントより遅れないようにする
+            manifest.save()
+            if checkpoint is not None:
+                checkpoint.save(posts[-1]["post_id"])
+            print(f"batch {batch_id} is completed. succeeded: {succeeded}, skipped: {skipped}, failed: {failed}")
+            batch_id += 1
+    return total_succeeded, total_skipped, total_failed
+
+
+def get_client() -> Client:
+    return get_supabase_client(get_supabase_secret())
+
+
+def regenerate(
+    start_id: int,
+    end_id: int,
+    render_workers: Optional[int] = None,
+    upload_workers: int = UPLOAD_WORKERS,
+    page_size: int = PAGE_SIZE,
+    checkpoint_path: str = CHECKPOINT_PATH,
+    failure_ledger_path: str = FAILURE_LEDGER_PATH,
+    restart: bool = False,
+    manifest_path: str = MANIFEST_PATH,
+    check_remote: bool = False,
+    force: bool = False,
+) -> Tuple[int, int, int]:
+    client = get_client()
+    checkpoint = Checkpoint(checkpoint_path, start_id, end_id)
+    after_post_id = None if restart else checkpoint.load()
+    if after_post_id is not None:
+        print(f"resume from post_id > {after_post_id}")
+    ledger = FailureLedger(failure_ledger_path)
+    manifest = FingerprintManifest(manifest_path)
+
+    pages = iter_post_pages(client, start_id, end_id, after_post_id, page_size)
+    succeeded, skipped, failed = run_pages(
+        pages, ledger, manifest, check_remote and not force, render_workers, upload_workers, checkpoint, force
+    )
+    # 最後まで処理できたらチェックポイントは不要
+    checkpoint.clear()
+    print(f"regeneration is completed. succeeded: {succeeded}, skipped: {skipped}, failed: {failed}")
+    return succeeded, skipped, failed
+
+
+def replay_failures(
+    render_workers: Optional[int] = None,
+    upload_workers: int = UPLOAD_WORKERS,
+    page_size: int = PAGE_SIZE,
+    failure_ledger_path: str = FAILURE_LEDGER_PATH,
+    manifest_path: str = MANIFEST_PATH,
+) -> Tuple[int, int, int]:
+    # 再実行中の台帳は退避しておき、今回も失敗したものだけを新しい台帳に記録する
+    replaying_path = f"{failure_ledger_path}.replaying"
+    ledger = FailureLedger(failure_ledger_path)
+    post_ids = ledger.load_post_ids(replaying_path)
+    if os.path.exists(failure_ledger_path):
+        post_ids = list(dict.fromkeys(post_ids + ledger.load_post_ids()))
+        os.replace(failure_ledger_path, replaying_path)
+    if not post_ids:
+        print("There are no failed posts to replay.")
+        return 0, 0, 0
+    print(f"replaying {len(post_ids)} failed posts...")
+
+    pages = iter_posts_by_ids(get_client(), sorted(post_ids), page_size)
+    manifest = FingerprintManifest(manifest_path)
+    succeeded, skipped, failed = run_pages(pages, ledger, manifest, False, render_workers, upload_workers)
+    os.remove(replaying_path)
+    print(f"replay is completed. succeeded: {succeeded}, skipped: {skipped}, failed: {failed}")
+    return succeeded, skipped, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OG画像を一括で再生成する")
+    parser.add_argument("--start-id", type=int, default=30000)
+    parser.add_argument("--end-id", type=int, default=50000)
+    parser.add_argument("--render-workers", type=int, default=None, help="描画プロセス数（デフォルトはCPUコア数）")
+    parser.add_argument("--upload-workers", type=int, default=UPLOAD_WORKERS)
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE)
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH)
+    parser.add_argument("--failure-ledger", default=FAILURE_LEDGER_PATH)
+    parser.add_argument("--restart", action="store_true", help="チェックポイントを無視して最初から処理する")
+    parser.add_argument("--replay", action="store_true", help="失敗台帳に記録された投稿だけを再生成する")
+    parser.add_argument("--manifest", default=MANIFEST_PATH)
+    parser.add_argument("--check-remote", action="store_true", help="マニフェストにない投稿はS3のメタデータと比較する")
+    parser.add_argument("--force", action="store_true", help="フィンガープリントを無視してすべて再生成する")
+    args = parser.parse_args()
+
+    if args.replay:
+        replay_failures(args.render_workers, args.upload_workers, args.page_size, args.failure_ledger, args.manifest)
+    else:
+        regenerate(
+            args.start_id, args.end_id, args.render_workers, args.upload_workers, args.page_size,
+            args.checkpoint, args.failure_ledger, args.restart, args.manifest, args.check_remote, args.force,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""
+OG画像作成処理のベンチマーク
+
+test_postsと、それをもとに合成した数千件規模のアーカイブに対して、以下の段階ごとに処理時間を計測する
+- extract : 本文のHTMLから5W1Hの表を取り出す
+- layout  : 下地の取得とコンテンツの折り返し・配置の計算
+- draw    : 下地のコピーとコンテンツの描画
+- encode  : JPEGへのエンコード
+- upload  : ローカルのS3の代替（またはS3互換のエンドポイント）へのアップロード
+
+出力プロファイルは環境変数OG_IMAGE_PROFILEで切り替える。結果はJSONで出力する。--baselineを指定すると、各段階の平均時間が基準の--threshold倍を超えた場合に終了コード1で終了する。
+
+python ServerlessFramework/CreateOGImage/benchmark.py --synthetic 5000 --output tmp/og_benchmark.json
+python ServerlessFramework/CreateOGImage/benchmark.py --synthetic 5000 --baseline tmp/og_benchmark.json --threshold 1.25
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from typing import Dict, Final, List, Optional
+
+import boto3
+import PIL
+
+import lambda_function
+from benchmark_table_extractor import build_post_content
+from lambda_function import (
+    S3_BUCKET_NAME,
+    draw_image,
+    encode_image,
+    get_render_context,
+    layout_contents,
+    test_posts,
+    upload_to_s3,
+)
+from table_extractor import extract_table_data
+
+
+STAGES: Final[List[str]] = ["extract", "layout", "draw", "encode", "upload"]
+
+
+class LocalS3:
+    # put_object/head_objectだけを持つS3の代替。オブジェクトはローカルのディレクトリに書き出す
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, bucket: str, key: str) -> str:
+        return os.path.join(self.root, bucket, key)
+
+    def put_object(self, Bucket: str, Key: str, Body: bytes, Metadata: Optional[Dict[str, str]] = None, **kwargs):
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(Body)
+        with open(f"{path}.metadata.json", "w") as f:
+            json.dump(Metadata or {}, f)
+
+    def head_object(self, Bucket: str, Key: str):
+        with open(f"{self._path(Bucket, Key)}.metadata.json") as f:
+            return {"Metadata": json.load(f)}
+
+
+def build_synthetic_posts(count: int, seed: int) -> List[Dict]:
+    # test_postsの値を組み合わせ、本文の長さも変えた投稿を作る
+    rng = random.Random(seed)
+    keys = list(test_posts[0]["post_content"].keys())
+    posts = []
+    for i in range(count):
+        table_data = {
+            key: rng.choice(test_posts)["post_content"].get(key, "")
+            for key in keys
+        }
+        if rng.random() < 0.1:
+            table_data.pop("Then(どうした)")
+        posts.append({
+            "post_id": 100000 + i,
+            "post_content": build_post_content(table_data, rng.choice([2, 10, 40, 120])),
+        })
+    return posts
+
+
+def build_fixture_posts() -> List[Dict]:
+    return [
+        {"post_id": post["post_id"], "post_content": build_post_content(post["post_content"], 10)}
+        for post in test_posts
+    ]
+
+
+def summarize(durations: List[float]) -> Dict[str, float]:
+    durations_ms = sorted(duration * 1000 for duration in durations)
+    return {
+        "count": len(durations_ms),
+        "total_ms": sum(durations_ms),
+        "mean_ms": statistics.mean(durations_ms),
+        "p50_ms": durations_ms[len(durations_ms) // 2],
+        "p95_ms": durations_ms[min(len(durations_ms) - 1, int(len(durations_ms) * 0.95))],
+        "max_ms": durations_ms[-1],
+    }
+
+
+def run_benchmark(posts: List[Dict]) -> Dict[str, Dict[str, float]]:
+    durations: Dict[str, List[float]] = {stage: [] for stage in STAGES}
+    for post in posts:
+        t0 = time.perf_counter()
+        table_data = extract_table_data(post["post_content"])
+        t1 = time.perf_counter()
+        layout, placements = layout_contents(table_data)
+        t2 = time.perf_counter()
+        im = draw_image(layout, placements)
+        t3 = time.perf_counter()
+        image_bytes = encode_image(im)
+        t4 = time.perf_counter()
+        upload_to_s3(post_id=post["post_id"], image_bytes=image_bytes)
+        t5 = time.perf_counter()
+        for stage, duration in zip(STAGES, [t1 - t0, t2 - t1, t3 - t2, t4 - t3, t5 - t4]):
+            durations[stage].append(duration)
+    return {stage: summarize(stage_durations) for stage, stage_durations in durations.items()}
+
+
+def find_regressions(report: Dict, baseline: Dict, threshold: float) -> List[str]:
+    regressions = []
+    for dataset, stages in report["datasets"].items():
+        for stage, summary in stages.items():
+            base = baseline.get("datasets", {}).get(dataset, {}).get(stage)
+            if base is None:
+                continue
+            ratio = summary["mean_ms"] / base["mean_ms"] if base["mean_ms"] > 0 else 1.0
+            if ratio > threshold:
+                regressions.append(
+                    f"{dataset}/{stage}: {base['mean_ms']:.3f}ms -> {summary['mean_ms']:.3f}ms (x{ratio:.2f})"
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OG画像作成処理のベンチマーク")
+    parser.add_argument("--synthetic", type=int, default=2000, help="合成する投稿数（0で合成しない）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="結果のJSONの出力先（省略時は標準出力）")
+    parser.add_argument("--baseline", default=None, help="比較する基準のJSON")
+    parser.add_argument("--threshold", type=float, default=1.25, help="基準に対して許容する平均時間の倍率")
+    parser.add_argument("--s3-endpoint-url", default=None, help="S3互換のエンドポイント（MinIOなど）。省略時はローカルのディレクトリ")
+    args = parser.parse_args()
+
+    # 出力先と基準が同じファイルでも比較できるよう、先に読み込んでおく
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    with tempfile.TemporaryDirectory() as upload_root:
+        # アップロード先をS3の代替に差し替える
+        if args.s3_endpoint_url:
+            lambda_function._s3_client = boto3.client("s3", endpoint_url=args.s3_endpoint_url)
+            lambda_function._s3_client.create_bucket(Bucket=S3_BUCKET_NAME)
+        else:
+            lambda_function._s3_client = LocalS3(upload_root)
+
+        # フォントの読み込みなど初回だけの準備は別に計測する
+        t0 = time.perf_counter()
+        get_render_context()
+        setup_ms = (time.perf_counter() - t0) * 1000
+
+        datasets = {"fixtures": run_benchmark(build_fixture_posts())}
+        if args.synthetic > 0:
+            datasets["synthetic"] = run_benchmark(build_synthetic_posts(args.synthetic, args.seed))
+
+    report = {
+        "created_at": datetime.datetime.now().isoformat(),
+        "environment": {
+            "python": platform.python_version(),
+            "pillow": PIL.__version__,
+            "platform": platform.platform(),
+        },
+        "output_profile": lambda_function.OUTPUT_PROFILE.name,
+        "setup_ms": setup_ms,
+        "synthetic_posts": args.synthetic,
+        "datasets": datasets,
+    }
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if baseline is not None:
+        regressions = find_regressions(report, baseline, args.threshold)
+        if regressions:
+            print("Performance regressions detected:", file=sys.stderr)
+            for regression in regressions:
+                print(f"  {regression}", file=sys.stderr)
+            sys.exit(1)
+        print(f"No stage is slower than x{args.threshold} of the baseline.", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
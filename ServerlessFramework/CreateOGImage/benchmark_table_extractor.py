@@ -0,0 +1,84 @@
+"""
+5W1Hの表の抽出処理のベンチマーク
+
+従来のBeautifulSoupによる抽出とtable_extractor.extract_table_dataを、実際の投稿と同程度の長さの本文で比較する。
+両者の抽出結果が一致することも確認する。
+BeautifulSoupはLambdaでは使わないため、requirements-dev.txtでインストールする。
+
+pip install -r ServerlessFramework/CreateOGImage/requirements-dev.txt
+
+python ServerlessFramework/CreateOGImage/benchmark_table_extractor.py --repeat 200
+"""
+import argparse
+import html
+import random
+import time
+from typing import Callable, Dict, List
+
+from lambda_function import test_posts
+from table_extractor import extract_table_data
+
+
+PARAGRAPH = "最初は冗談のつもりだったが、相手の表情を見てすぐに失言だったと気づいた。今思えば、場の空気を読むことよりも自分の考えを正しく伝えることを優先してしまっていたのだと思う。"
+
+
+def extract_with_beautifulsoup(post_content: str) -> Dict[str, str]:
+    # 以前のget_text_dataと同じ処理
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(post_content, "html.parser")
+    table_data_raw = soup.find("table").find_all("td")
+    return {
+        table_data_raw[2 * i].text: table_data_raw[2 * i + 1].text
+        for i in range(len(table_data_raw) // 2)
+    }
+
+
+def build_post_content(table_data: Dict[str, str], paragraph_count: int) -> str:
+    rows = "".join(
+        f"<tr><td>{html.escape(key)}</td><td>{html.escape(value)}</td></tr>"
+        for key, value in table_data.items()
+    )
+    body = "".join(
+        f"<h3>見出し{i}</h3><p>{PARAGRAPH * 3}</p><ul><li>{PARAGRAPH}</li></ul>"
+        for i in range(paragraph_count)
+    )
+    return f"<table><tbody>{rows}</tbody></table>{body}"
+
+
+def build_post_contents(count: int, seed: int = 0) -> List[str]:
+    # 短い投稿から数万文字の長い投稿までを混ぜる
+    rng = random.Random(seed)
+    return [
+        build_post_content(test_posts[i % len(test_posts)]["post_content"], rng.choice([2, 10, 40, 120]))
+        for i in range(count)
+    ]
+
+
+def measure(extract: Callable[[str], Dict[str, str]], post_contents: List[str], repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for post_content in post_contents:
+            extract(post_content)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="5W1Hの表の抽出処理のベンチマーク")
+    parser.add_argument("--posts", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    post_contents = build_post_contents(args.posts)
+    for post_content in post_contents:
+        assert extract_table_data(post_content) == extract_with_beautifulsoup(post_content)
+
+    average_length = sum(len(post_content) for post_content in post_contents) // len(post_contents)
+    count = args.posts * args.repeat
+    print(f"posts: {args.posts}, repeat: {args.repeat}, average length: {average_length} chars")
+    for name, extract in [("beautifulsoup", extract_with_beautifulsoup), ("table_extractor", extract_table_data)]:
+        elapsed = measure(extract, post_contents, args.repeat)
+        print(f"{name}: {elapsed:.3f}s total, {elapsed / count * 1000:.3f}ms/post")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Lambdaではレイヤーが/opt/pythonに展開される。ローカルではリポジトリ内のレイヤーを参照する
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "layers", "hpe_runtime", "python"))
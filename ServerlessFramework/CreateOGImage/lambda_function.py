@@ -1,13 +1,14 @@
-from bs4 import BeautifulSoup
 from PIL import Image, ImageDraw, ImageFont
-import textwrap
-from typing import Final, Dict, List
-import boto3
+from typing import Any, Final, Dict, List, NamedTuple, Optional, Tuple, Union
+from botocore.exceptions import ClientError
+import hashlib
 import json
 import re
-from supabase import create_client, Client
+from hpe_runtime import get_boto3_client, get_secret, get_supabase_client, log_cache_stats
+from table_extractor import extract_table_data
+from text_fitting import TextFitter
 import logging
-import datetime
+import io
 import os
 
 
@@ -15,7 +16,10 @@ IS_PRODUCTION = os.getenv('AWS_LAMBDA_FUNCTION_NAME') is not None
 
 S3_BUCKET_NAME: Final[str] = "healthy-person-emulator-public-assets"
 FONT_FILE_PATH: Final[str] = "./NotoSansJP-Medium.ttf" if IS_PRODUCTION else "ServerlessFramework/CreateOGImage/NotoSansJP-Medium.ttf"
-TEMP_FILE_PATH: Final[str] = "/tmp/{}.jpg" if IS_PRODUCTION else "./tmp/{}.jpg"
+TEMP_FILE_PATH: Final[str] = "/tmp/{}" if IS_PRODUCTION else "./tmp/{}"
+# 画像はメモリ上でエンコードしてS3へ直接アップロードする。ファイルへの書き出しはデバッグ用のオプトイン
+SAVE_DEBUG_IMAGE: Final[bool] = os.getenv("OG_IMAGE_DEBUG_OUTPUT") == "1"
+OG_IMAGE_CACHE_CONTROL: Final[str] = "public, max-age=86400"
 
 logger = logging.getLogger()
 
@@ -27,7 +31,56 @@ FONT_SIZE: Final[int] = 30
 WIDTH_MARGIN: Final[int] = 20
 HEIGHT_MARGIN: Final[int] = 20
 AVAILABLE_HEIGHT: Final[int] = IMAGE_HEIGHT - (2 * HEIGHT_MARGIN)
+CONTENT_TEXT_WIDTH: Final[int] = CONTENT_COLUMN_WIDTH - (2 * WIDTH_MARGIN)
 UPPER_PADDING_RATIO: Final[float] = 0.65 # 上方向のパディングを調整する比率
+BACKGROUND_COLOR: Final[Tuple[int, int, int]] = (245, 245, 245)
+LINE_COLOR: Final[Tuple[int, int, int]] = (0, 0, 0)
+TEXT_COLOR: Final[Tuple[int, int, int]] = (0, 0, 0)
+STANDARD_KEYS: Final[List[str]] = [
+    "Who(誰が)", "When(いつ)", "Where(どこで)", "Why(なぜ)", "What(何を)", "How(どのように)", "Then(どうした)"
+]
+KEY_WEIGHTS: Final[Dict[str, int]] = {"Then(どうした)": 2, "Why(なぜ)": 2}
+MAX_CACHED_LAYOUTS: Final[int] = 32 # レイアウトパターン（キーの並び）ごとの下地画像のキャッシュ上限
+
+
+class OutputProfile(NamedTuple):
+    name: str
+    mode: str # 描画時のモード（"RGB" / "L"）。白黒の画像なので"L"でも見た目は変わらない
+    format: str # "JPEG" / "PNG" / "WEBP"
+    save_options: Dict[str, Any]
+    palette_colors: Optional[int] = None # 指定した場合はエンコード前にこの色数のパレット画像に変換する
+    target_bytes: Optional[int] = None # 指定した場合はこのサイズに収まる最も高い品質でエンコードする
+
+
+# 環境変数OG_IMAGE_PROFILEで選択する。JPEG以外ではS3のキーの拡張子も変わるが、既存の投稿のogp_image_urlは更新しない
+OUTPUT_PROFILES: Final[Dict[str, OutputProfile]] = {
+    profile.name: profile for profile in [
+        OutputProfile("default", "RGB", "JPEG", {"quality": 95}),
+        OutputProfile("jpeg-gray", "L", "JPEG", {"quality": 85, "optimize": True, "progressive": True}),
+        OutputProfile("png-palette", "L", "PNG", {"optimize": True}, palette_colors=16),
+        OutputProfile("webp", "L", "WEBP", {"quality": 80, "method": 6}),
+        OutputProfile("jpeg-budget", "L", "JPEG", {"optimize": True, "progressive": True}, target_bytes=40_000),
+    ]
+}
+OUTPUT_PROFILE: Final[OutputProfile] = OUTPUT_PROFILES[os.getenv("OG_IMAGE_PROFILE", "default")]
+CONTENT_TYPES: Final[Dict[str, str]] = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+FILE_EXTENSIONS: Final[Dict[str, str]] = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp"}
+MIN_BUDGET_QUALITY: Final[int] = 30 # target_bytesに収めるために下げる品質の下限
+MAX_BUDGET_QUALITY: Final[int] = 95
+MIN_BUDGET_SCALE: Final[float] = 0.5 # 下限の品質でも収まらない場合に縮小する倍率の下限
+BUDGET_SCALE_STEP: Final[float] = 0.8
+
+# 描画結果が変わる変更をしたらLAYOUT_REVISIONを上げる。レイアウト定数の変更はLAYOUT_VERSIONに自動で反映される
+LAYOUT_REVISION: Final[int] = 2
+LAYOUT_VERSION: Final[str] = hashlib.sha256(json.dumps([
+    LAYOUT_REVISION, IMAGE_WIDTH, IMAGE_HEIGHT, KEY_COLUMN_WIDTH, FONT_SIZE, WIDTH_MARGIN, HEIGHT_MARGIN,
+    UPPER_PADDING_RATIO, BACKGROUND_COLOR, LINE_COLOR, TEXT_COLOR, KEY_WEIGHTS, os.path.basename(FONT_FILE_PATH),
+    OUTPUT_PROFILE,
+], ensure_ascii=False).encode("utf-8")).hexdigest()[:16]
+FINGERPRINT_METADATA_KEY: Final[str] = "og-fingerprint"
+
+OGP_CLAIM_BATCH_SIZE: Final[int] = 20 # 1回の実行で確保する投稿数の上限
+OGP_CLAIM_LEASE_MINUTES: Final[int] = 15 # 確保したまま完了しなかった投稿を再度確保できるまでの時間
 
 """
 画像作成アルゴリズムは以下の通り
@@ -40,160 +93,336 @@ UPPER_PADDING_RATIO: Final[float] = 0.65 # 上方向のパディングを調整
 - 次に、([WIDTH_MARGIN], [HEIGHT_MARGIN + LINE_HEIGHT + LINE_HEIGHT + LINE_HEIGHT])から([IMAGE_WIDTH-WIDTH_MARGIN], [HEIGHT_MARGIN + LINE_HEIGHT + LINE_HEIGHT + LINE_HEIGHT])までの横線を引く
 ....
 4. 次に、エントリーごとのキーとコンテンツを書く
+- コンテンツはピクセル幅で折り返し（text_fitting.py）、収まらない分は省略記号で切り詰める
+
+1〜3とキーの描画結果はレイアウトパターン（キーの並び）ごとにRenderContextへキャッシュし、
+投稿ごとには下地をコピーしてコンテンツのみを描画する
 """
 
 def get_supabase_secret():
-    client = boto3.client("secretsmanager")
-    response = client.get_secret_value(
-        SecretId="SUPABASE_CONNECTION_SECRET"
-    )
-    secret = response['SecretString']
-    return json.loads(secret)
+    return get_secret("SUPABASE_CONNECTION_SECRET")
 
 def poll_supabase_for_new_posts(secrets):
-    client: Client = create_client(secrets["SUPABASE_URL"], secrets["SUPABASE_SERVICE_ROLE_KEY"])
-    one_day_ago = datetime.datetime.now() - datetime.timedelta(hours=24)
-    posts = client.table("dim_posts").select("post_id,post_content,post_title").gte('post_date_gmt', one_day_ago).eq("is_sns_shared", False).eq("is_welcomed", True).execute()
-    # posts = client.table("dim_posts").select("post_id,post_content,post_title").order("post_id", desc=True).limit(10).execute()
+    # 対象の投稿を処理中としてまとめて確保し、必要な列だけを受け取る（本文は5W1Hの表の部分のみ）
+    # 関数の定義はsql/ogp_claim_functions.sqlを参照
+    client = get_supabase_client(secrets)
+    posts = client.rpc("claim_posts_for_ogp", {
+        "batch_size": OGP_CLAIM_BATCH_SIZE,
+        "lease_minutes": OGP_CLAIM_LEASE_MINUTES,
+    }).execute()
     data = []
     for post in posts.data:
         data.append({
             "post_id": post["post_id"],
             "post_title": post["post_title"],
-            "post_content": get_text_data(post["post_content"])
+            "post_content": get_text_data(post["post_table_html"])
         })
     return data
 
-def get_text_data(post_content: str) -> List[Dict[str, str]]:
-    soup = BeautifulSoup(post_content, "html.parser")
-    table_data_raw = soup.find("table").find_all("td")
-    table_data = {
-        table_data_raw[2 * i].text: table_data_raw[2 * i + 1].text
-        for i in range(len(table_data_raw) // 2)
-    }
-    return table_data
+def get_text_data(post_content: str) -> Dict[str, str]:
+    # 表がない投稿では空の辞書を返す
+    return extract_table_data(post_content)
 
 
-def get_image(
-    table_data: Dict[str, str], post_id: int
-) -> None:
+def get_key_weight(key: str) -> int:
+    return KEY_WEIGHTS.get(key, 1)
 
-    try:
-        with open(FONT_FILE_PATH):
-            pass
-    except FileNotFoundError:
-        raise FileNotFoundError("The specified font file does not exist.")
 
-    font = ImageFont.truetype(FONT_FILE_PATH, FONT_SIZE)
+def convert_color(color: Tuple[int, int, int], mode: str) -> Union[int, Tuple[int, int, int]]:
+    if mode == "L":
+        # PillowのRGB→L変換と同じ輝度の計算式
+        return round(color[0] * 299 / 1000 + color[1] * 587 / 1000 + color[2] * 114 / 1000)
+    return color
 
-    # 固定サイズの画像を作成
-    im = Image.new("RGB", (IMAGE_WIDTH, IMAGE_HEIGHT), (245, 245, 245))
-    draw = ImageDraw.Draw(im)
 
-    # 各キーの重みを定義
-    def get_key_weight(key: str) -> int:
-        return 2 if key in ["Then(どうした)", "Why(なぜ)"] else 1
-    
-    total_weight = sum(get_key_weight(key) for key in table_data.keys())
-    unit_height = AVAILABLE_HEIGHT // total_weight
-
-    # 縦線の描画（keyカラムとcontentカラムの区切り）
-    draw.line(
-        [(KEY_COLUMN_WIDTH, HEIGHT_MARGIN), (KEY_COLUMN_WIDTH, IMAGE_HEIGHT - HEIGHT_MARGIN)],
-        fill=(0, 0, 0),
-        width=1,
-    )
+def get_object_key(post_id: int) -> str:
+    return "{}.{}".format(post_id, FILE_EXTENSIONS[OUTPUT_PROFILE.format])
+
+
+def get_og_image_url(post_id: int) -> str:
+    return f"https://{S3_BUCKET_NAME}.s3-ap-northeast-1.amazonaws.com/{get_object_key(post_id)}"
+
+
+class LayoutRow(NamedTuple):
+    key: str
+    top: int
+    line_height: int
+    is_double_height: bool
+
+
+class Layout(NamedTuple):
+    base_image: Image.Image
+    rows: List[LayoutRow]
+
 
-    # 横線の描画位置を計算
-    current_y = HEIGHT_MARGIN
-    for key in list(table_data.keys())[:-1]:  # 最後のエントリーの後には線を引かない
-        current_y += unit_height * get_key_weight(key)
+class RenderContext:
+    """
+    フォント・キーの寸法・レイアウトパターンごとの下地画像を保持する
+    モジュールレベルで1つだけ作成し、投稿間・ウォームスタート間で使い回す
+    """
+
+    def __init__(self, font_file_path: str, font_size: int, mode: str):
+        if not os.path.exists(font_file_path):
+            raise FileNotFoundError("The specified font file does not exist.")
+        self.mode = mode
+        self.background_color = convert_color(BACKGROUND_COLOR, mode)
+        self.line_color = convert_color(LINE_COLOR, mode)
+        self.text_color = convert_color(TEXT_COLOR, mode)
+        self.font = ImageFont.truetype(font_file_path, font_size)
+        self.text_fitter = TextFitter(self.font)
+        self._measure_draw = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+        self._key_sizes: Dict[str, Tuple[int, int]] = {}
+        self._layouts: Dict[Tuple[str, ...], Layout] = {}
+        for key in STANDARD_KEYS:
+            self.measure_key(key)
+
+    def measure_key(self, key: str) -> Tuple[int, int]:
+        size = self._key_sizes.get(key)
+        if size is None:
+            key_bbox = self._measure_draw.textbbox((0, 0), key, font=self.font)
+            size = (key_bbox[2] - key_bbox[0], key_bbox[3] - key_bbox[1])
+            self._key_sizes[key] = size
+        return size
+
+    def get_layout(self, keys: Tuple[str, ...]) -> Layout:
+        # レイアウトはキーの並び（とそこから決まる重み）だけで決まる
+        layout = self._layouts.get(keys)
+        if layout is None:
+            layout = self._build_layout(keys)
+            if len(self._layouts) >= MAX_CACHED_LAYOUTS:
+                self._layouts.pop(next(iter(self._layouts)))
+            self._layouts[keys] = layout
+        return layout
+
+    def _build_layout(self, keys: Tuple[str, ...]) -> Layout:
+        # 固定サイズの画像を作成
+        im = Image.new(self.mode, (IMAGE_WIDTH, IMAGE_HEIGHT), self.background_color)
+        draw = ImageDraw.Draw(im)
+
+        total_weight = sum(get_key_weight(key) for key in keys)
+        unit_height = AVAILABLE_HEIGHT // total_weight
+
+        # 縦線の描画（keyカラムとcontentカラムの区切り）
         draw.line(
-            [(WIDTH_MARGIN, current_y), (IMAGE_WIDTH - WIDTH_MARGIN, current_y)],
-            fill=(0, 0, 0),
+            [(KEY_COLUMN_WIDTH, HEIGHT_MARGIN), (KEY_COLUMN_WIDTH, IMAGE_HEIGHT - HEIGHT_MARGIN)],
+            fill=self.line_color,
             width=1,
         )
 
-    # エントリーの描画
-    current_y = HEIGHT_MARGIN
-    for key, content in table_data.items():
-        line_height = unit_height * get_key_weight(key)
-        is_double_height = get_key_weight(key) == 2
-
-        # キーのテキストボックスサイズを取得
-        key_bbox = draw.textbbox((0, 0), key, font=font)
-        key_width = key_bbox[2] - key_bbox[0]
-        key_height = key_bbox[3] - key_bbox[1]
-        key_padding = (line_height - key_height) / 2
-        
-        # キーの描画位置を右揃えに調整
-        key_x = KEY_COLUMN_WIDTH - WIDTH_MARGIN - key_width
-        key_y = current_y + key_padding * UPPER_PADDING_RATIO
+        # 横線の描画位置を計算
+        current_y = HEIGHT_MARGIN
+        for key in keys[:-1]:  # 最後のエントリーの後には線を引かない
+            current_y += unit_height * get_key_weight(key)
+            draw.line(
+                [(WIDTH_MARGIN, current_y), (IMAGE_WIDTH - WIDTH_MARGIN, current_y)],
+                fill=self.line_color,
+                width=1,
+            )
 
         # キーの描画
+        rows = []
+        current_y = HEIGHT_MARGIN
+        for key in keys:
+            line_height = unit_height * get_key_weight(key)
+            key_width, key_height = self.measure_key(key)
+            key_padding = (line_height - key_height) / 2
+
+            # キーの描画位置を右揃えに調整
+            key_x = KEY_COLUMN_WIDTH - WIDTH_MARGIN - key_width
+            key_y = current_y + key_padding * UPPER_PADDING_RATIO
+            draw.text(
+                (key_x, key_y),
+                key,
+                font=self.font,
+                fill=self.text_color
+            )
+
+            rows.append(LayoutRow(key, current_y, line_height, get_key_weight(key) == 2))
+            current_y += line_height
+
+        return Layout(im, rows)
+
+
+_render_context: Optional[RenderContext] = None
+
+
+def get_render_context() -> RenderContext:
+    global _render_context
+    if _render_context is None:
+        _render_context = RenderContext(FONT_FILE_PATH, FONT_SIZE, OUTPUT_PROFILE.mode)
+    return _render_context
+
+
+class ContentPlacement(NamedTuple):
+    y: float
+    text: str
+
+
+def layout_contents(table_data: Dict[str, str]) -> Tuple[Layout, List[ContentPlacement]]:
+    if not table_data:
+        raise ValueError("table_data is empty. The post has no 5W1H table.")
+    context = get_render_context()
+    layout = context.get_layout(tuple(table_data.keys()))
+
+    placements = []
+    for row, content in zip(layout.rows, table_data.values()):
+        # 2倍の高さのエントリーは2行まで、それ以外は1行まで表示し、溢れた分は省略記号で切り詰める
+        fitted = context.text_fitter.fit(content, CONTENT_TEXT_WIDTH, 2 if row.is_double_height else 1)
+        if not fitted.lines:
+            continue
+        content_padding = (row.line_height - fitted.height) / 2
+        # 上方向のパディングを調整（約10%減少）
+        content_y = row.top + content_padding * UPPER_PADDING_RATIO
+        placements.append(ContentPlacement(content_y, "\n".join(fitted.lines)))
+    return layout, placements
+
+
+def draw_image(layout: Layout, placements: List[ContentPlacement]) -> Image.Image:
+    context = get_render_context()
+    # 下地（背景・罫線・キー）をコピーし、コンテンツのみ描画する
+    im = layout.base_image.copy()
+    draw = ImageDraw.Draw(im)
+    for placement in placements:
         draw.text(
-            (key_x, key_y),
-            key,
-            font=font,
-            fill=(0, 0, 0)
+            (KEY_COLUMN_WIDTH + WIDTH_MARGIN, placement.y),
+            placement.text,
+            font=context.font,
+            fill=context.text_color
+        )
+    return im
+
+
+def render_image(table_data: Dict[str, str]) -> Image.Image:
+    return draw_image(*layout_contents(table_data))
+
+
+def save_to_bytes(im: Image.Image, format: str, **save_options) -> bytes:
+    buffer = io.BytesIO()
+    im.save(buffer, format=format, **save_options)
+    return buffer.getvalue()
+
+
+def search_budget_quality(im: Image.Image, profile: OutputProfile) -> Optional[bytes]:
+    # target_bytes以下に収まる最も高い品質を二分探索する。下限の品質でも収まらなければNoneを返す
+    smallest = save_to_bytes(im, profile.format, quality=MIN_BUDGET_QUALITY, **profile.save_options)
+    if len(smallest) > profile.target_bytes:
+        return None
+    best = smallest
+    low, high = MIN_BUDGET_QUALITY + 1, MAX_BUDGET_QUALITY
+    while low <= high:
+        quality = (low + high) // 2
+        encoded = save_to_bytes(im, profile.format, quality=quality, **profile.save_options)
+        if len(encoded) <= profile.target_bytes:
+            best = encoded
+            low = quality + 1
+        else:
+            high = quality - 1
+    return best
+
+
+def encode_within_budget(im: Image.Image, profile: OutputProfile, post_id: Optional[int] = None) -> bytes:
+    # 下限の品質でも収まらなければ、縮小して探し直す（SNSのカードは表示側で拡大されるため、品質を下げ続けるより読みやすい）
+    scale = 1.0
+    while True:
+        scaled = im if scale == 1.0 else im.resize(
+            (round(im.width * scale), round(im.height * scale)), Image.LANCZOS
         )
+        encoded = search_budget_quality(scaled, profile)
+        if encoded is not None:
+            if scale < 1.0:
+                logger.setLevel("INFO")
+                logger.info(f"post_id: {post_id} OG Image is downscaled to {scaled.size} to fit {profile.target_bytes} bytes.")
+            return encoded
+        if scale <= MIN_BUDGET_SCALE:
+            break
+        scale = max(MIN_BUDGET_SCALE, scale * BUDGET_SCALE_STEP)
+
+    # 最小の縮小率・下限の品質でも収まらない場合は、予算を超えたまま返す
+    encoded = save_to_bytes(scaled, profile.format, quality=MIN_BUDGET_QUALITY, **profile.save_options)
+    logger.setLevel("WARNING")
+    logger.warning(
+        f"post_id: {post_id} OG Image is {len(encoded)} bytes, over the budget of {profile.target_bytes} bytes "
+        f"({profile.name}) even at quality {MIN_BUDGET_QUALITY} and size {scaled.size}."
+    )
+    return encoded
 
-        # コンテンツの描画
-        content_width = (CONTENT_COLUMN_WIDTH - WIDTH_MARGIN * 2) // FONT_SIZE - 1
-        content_lines = textwrap.wrap(content, width=content_width)
-        
-        if content_lines:
-            if is_double_height:
-                # 2行まで表示可能な場合
-                if len(content_lines) > 2:
-                    content_text = content_lines[0] + "\n" + content_lines[1] + "..."
-                elif len(content_lines) == 2:
-                    content_text = content_lines[0] + "\n" + content_lines[1]
-                else:
-                    content_text = content_lines[0]
-                
-                # 2行テキストの場合の高さ計算
-                content_bbox = draw.multiline_textbbox((0, 0), content_text, font=font)
-                content_height = content_bbox[3] - content_bbox[1]
-                content_padding = (line_height - content_height) / 2
-                # 上方向のパディングを調整（約10%減少）
-                content_y = current_y + content_padding * UPPER_PADDING_RATIO
-            else:
-                # 1行のみの場合
-                content_text = content_lines[0] + ("..." if len(content_lines) > 1 else "")
-                content_bbox = draw.textbbox((0, 0), content_text, font=font)
-                content_height = content_bbox[3] - content_bbox[1]
-                content_padding = (line_height - content_height) / 2
-                # 上方向のパディングを調整（約10%減少）
-                content_y = current_y + content_padding * UPPER_PADDING_RATIO
 
-            draw.text(
-                (KEY_COLUMN_WIDTH + WIDTH_MARGIN, content_y),
-                content_text,
-                font=font,
-                fill=(0, 0, 0)
-            )
+def encode_image(im: Image.Image, profile: OutputProfile = OUTPUT_PROFILE, post_id: Optional[int] = None) -> bytes:
+    if profile.palette_colors is not None:
+        im = im.quantize(colors=profile.palette_colors)
+    if profile.target_bytes is not None:
+        return encode_within_budget(im, profile, post_id)
+    return save_to_bytes(im, profile.format, **profile.save_options)
+
+
+def save_debug_image(image_bytes: bytes, post_id: int) -> None:
+    file_path = TEMP_FILE_PATH.format(get_object_key(post_id))
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, "wb") as f:
+        f.write(image_bytes)
+
+
+def get_image(
+    table_data: Dict[str, str], post_id: int
+) -> bytes:
+    image_bytes = encode_image(render_image(table_data), post_id=post_id)
+    if SAVE_DEBUG_IMAGE:
+        save_debug_image(image_bytes, post_id)
+    return image_bytes
+
 
-        current_y += line_height
+_s3_client = None # ベンチマークなどでS3の代替に差し替える場合に設定する
 
-    im.save(TEMP_FILE_PATH.format(post_id), quality=95)    
 
-def upload_to_s3(post_id:int):
-    s3 = boto3.client("s3")
-    s3.upload_file(
-        TEMP_FILE_PATH.format(post_id),
-        S3_BUCKET_NAME,
-        "{}.jpg".format(post_id)
+def get_s3_client():
+    return _s3_client if _s3_client is not None else get_boto3_client("s3")
+
+
+def compute_fingerprint(table_data: Dict[str, str], post_title: str) -> str:
+    # キーの並びもレイアウトに影響するため、辞書の順序のまま含める
+    payload = json.dumps({
+        "layout_version": LAYOUT_VERSION,
+        "post_title": post_title,
+        "table_data": list(table_data.items()),
+    }, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def get_uploaded_fingerprint(post_id:int) -> Optional[str]:
+    try:
+        response = get_s3_client().head_object(Bucket=S3_BUCKET_NAME, Key=get_object_key(post_id))
+    except ClientError as e:
+        # s3:ListBucketの権限がない場合、存在しないキーには403が返る
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound", "403", "AccessDenied"):
+            return None
+        raise e
+    return response.get("Metadata", {}).get(FINGERPRINT_METADATA_KEY)
+
+
+def upload_to_s3(post_id:int, image_bytes:bytes, fingerprint:Optional[str]=None):
+    metadata = {FINGERPRINT_METADATA_KEY: fingerprint} if fingerprint else {}
+    get_s3_client().put_object(
+        Bucket=S3_BUCKET_NAME,
+        Key=get_object_key(post_id),
+        Body=image_bytes,
+        ContentType=CONTENT_TYPES[OUTPUT_PROFILE.format],
+        CacheControl=OG_IMAGE_CACHE_CONTROL,
+        Metadata=metadata,
     )
 
-def update_postgres_ogp_url(post_id:int, s3_url:str, secrets:Dict[str,str]):
-    client: Client = create_client(secrets["SUPABASE_URL"], secrets["SUPABASE_SERVICE_ROLE_KEY"])
-    client.table("dim_posts").update({"ogp_image_url": s3_url}).eq("post_id",post_id).execute()
-    client.table("dim_posts").update([{"is_sns_shared": True}]).eq("post_id",post_id).execute()
+def update_postgres_ogp_urls(completed_posts:List[Dict], secrets:Dict[str,str]):
+    # ogp_image_urlとis_sns_sharedを全件まとめて1回で更新し、確保を解除する
+    client = get_supabase_client(secrets)
+    client.rpc("complete_posts_for_ogp", {
+        "updates": [
+            {"post_id": post["post_id"], "ogp_image_url": post["ogp_image_url"]}
+            for post in completed_posts
+        ]
+    }).execute()
     return
 
 def invoke_sns_post(post_title, post_url, og_url, post_id):
-    sns = boto3.client("sns")
+    sns = get_boto3_client("sns")
     response = sns.publish(
         TopicArn="arn:aws:sns:ap-northeast-1:662924458234:healthy-person-emulator-socialpost",
         Message=json.dumps({
@@ -284,59 +513,65 @@ def lambda_handler(event, context):
             logger.info("There are no posts to create OG Image.")
             return
     
+        completed_posts = []
+        # テスト投稿や表のない投稿は画像を作らずに完了させる（確保したままにすると期限切れのたびに再度確保される）
+        skipped_post_ids = []
+        failed_post_ids = []
         for post in posts:
             post_id = post["post_id"]
             post_title = post["post_title"]
             post_url = f"https://healthy-person-emulator.org/archives/{post_id}"
             if re.match(r"^.*プログラムテスト.*$", post_title):
+                skipped_post_ids.append(post_id)
                 continue
-            get_image(post_id=post_id, table_data=post["post_content"])
-            s3_url = f"https://{S3_BUCKET_NAME}.s3-ap-northeast-1.amazonaws.com/{post_id}.jpg"
+            table_data = post["post_content"]
+            if not table_data:
+                logger.setLevel("WARNING")
+                logger.warning(f"post_id: {post_id} has no 5W1H table. skip creating OG Image.")
+                skipped_post_ids.append(post_id)
+                continue
+            s3_url = get_og_image_url(post_id)
             if not IS_PRODUCTION:
+                image_bytes = get_image(post_id=post_id, table_data=table_data)
+                if not SAVE_DEBUG_IMAGE:
+                    save_debug_image(image_bytes, post_id)
                 continue
-            upload_to_s3(post_id=post_id)
-            update_postgres_ogp_url(post_id=post_id, s3_url=s3_url, secrets=secrets)
-            post_url = f"https://healthy-person-emulator.org/archives/{post_id}"
-            invoke_sns_post(post_title=post_title, post_url=post_url, og_url=s3_url, post_id=post_id)
-            logger.setLevel("INFO")
-            logger.info(f"post_id: {post_id} is successfully created OG Image.")
+            try:
+                # 新しく確保した投稿にはまだ画像がないため、アップロード済みのフィンガープリントは確認しない
+                # （確認して描画を省くのは、既存の画像を作り直すbatch_regenerateだけ）
+                fingerprint = compute_fingerprint(table_data, post_title)
+                image_bytes = get_image(post_id=post_id, table_data=table_data)
+                upload_to_s3(post_id=post_id, image_bytes=image_bytes, fingerprint=fingerprint)
+            except Exception as e:
+                # 失敗した投稿は確保の期限切れ後に再度処理される
+                logger.setLevel("ERROR")
+                logger.error(f"post_id: {post_id} is failed to create OG Image. {e}")
+                failed_post_ids.append(post_id)
+                continue
+            completed_posts.append({"post_id": post_id, "post_title": post_title, "ogp_image_url": s3_url})
+
+        if IS_PRODUCTION and (completed_posts or skipped_post_ids):
+            skipped_posts = [{"post_id": post_id, "ogp_image_url": None} for post_id in skipped_post_ids]
+            update_postgres_ogp_urls(completed_posts=completed_posts + skipped_posts, secrets=secrets)
+            for post in completed_posts:
+                post_id = post["post_id"]
+                post_url = f"https://healthy-person-emulator.org/archives/{post_id}"
+                invoke_sns_post(post_title=post["post_title"], post_url=post_url, og_url=post["ogp_image_url"], post_id=post_id)
+                logger.setLevel("INFO")
+                logger.info(f"post_id: {post_id} is successfully created OG Image.")
+        log_cache_stats(logger)
+        if failed_post_ids:
+            raise RuntimeError(f"Failed to create OG Image. post_ids: {failed_post_ids}")
     except Exception as e:
         logger.setLevel("ERROR")
         logger.error(e)
         raise e
 
 def batch_update(start_id:int, end_id:int):
-    supabase_secrets = get_supabase_secret()
-    client: Client = create_client(supabase_secrets["SUPABASE_URL"], supabase_secrets["SUPABASE_SERVICE_ROLE_KEY"])
-    post_count = client.table("dim_posts").select("*", count="exact").gte("post_id", start_id).lte("post_id", end_id).execute()
-    print(f"post_count: {post_count.count}")
-    print(f"Num of batch: {post_count.count // 50}")
-    minimum_id = start_id
-    # 50件ずつ更新する
-    for i in range(0, post_count.count, 50):
-        batch_id = i // 50
-        print(f"batch {batch_id} is processing...")
-        posts = client.table("dim_posts").select("post_id,post_content").\
-            gte("post_id", minimum_id)\
-            .lte("post_id", end_id)\
-            .order("post_id")\
-            .limit(50)\
-            .execute()
-        print(f"batch {batch_id} Count: {len(posts.data)}")
-        print(f"batch {batch_id} Min ID: {posts.data[0]['post_id']}, Max ID: {posts.data[-1]['post_id']}")
-        for post in posts.data:
-            try: 
-                post_id = post["post_id"]
-                post_content = get_text_data(post["post_content"])
-                get_image(post_id=post_id, table_data=post_content)
-                upload_to_s3(post_id=post_id)
-            except Exception as e:
-                print(f"post_id: {post_id} is failed to create OG Image.")
-                with open(f"2025-01-01-OGP.txt", "a") as f:
-                    f.write(f"post_id: {post_id} is failed to create OG Image.\n")
-        print(f"batch {i // 50} is completed.")
-        minimum_id = posts.data[-1]["post_id"]
-        
+    # 一括再生成はbatch_regenerate.pyで並列・再開可能に行う
+    from batch_regenerate import regenerate
+    regenerate(start_id, end_id)
+
 if __name__ == "__main__":
 
     batch_update(30000, 50000)
@@ -0,0 +1,48 @@
+-- CreateOGImageが新規投稿をまとめて確保・完了するための定義
+-- Supabaseのダッシュボード（SQL Editor）で実行する
+
+alter table dim_posts add column if not exists ogp_claimed_at timestamptz;
+
+-- OG画像を作成する投稿を処理中として確保し、必要な列だけを返す
+-- 本文は5W1Hの表の部分だけを切り出して返す（閉じタグがない場合は表以降すべて）
+-- 確保からlease_minutes分経っても完了しなかった投稿は、再度確保できる
+create or replace function claim_posts_for_ogp(batch_size integer, lease_minutes integer)
+returns table (post_id bigint, post_title text, post_table_html text)
+language sql
+as $$
+  update dim_posts as d
+  set ogp_claimed_at = now()
+  where d.post_id in (
+    select p.post_id
+    from dim_posts as p
+    where p.post_date_gmt >= now() - interval '24 hours'
+      and p.is_sns_shared = false
+      and p.is_welcomed = true
+      and (p.ogp_claimed_at is null or p.ogp_claimed_at < now() - make_interval(mins => lease_minutes))
+    order by p.post_id
+    limit batch_size
+    for update skip locked
+  )
+  returning
+    d.post_id::bigint,
+    d.post_title::text,
+    coalesce(
+      substring(d.post_content from '(?i)<table.*?</table>'),
+      substring(d.post_content from '(?i)<table.*')
+    )::text;
+$$;
+
+-- ogp_image_urlとis_sns_sharedをまとめて更新し、確保を解除する
+-- updates: [{"post_id": 1, "ogp_image_url": "https://..."}, ...]
+-- 画像を作らない投稿（テスト投稿・表のない投稿）はogp_image_urlをnullにして渡し、既存の値を残したまま完了させる
+create or replace function complete_posts_for_ogp(updates jsonb)
+returns void
+language sql
+as $$
+  update dim_posts as d
+  set ogp_image_url = coalesce(u.ogp_image_url, d.ogp_image_url),
+      is_sns_shared = true,
+      ogp_claimed_at = null
+  from jsonb_to_recordset(updates) as u(post_id bigint, ogp_image_url text)
+  where d.post_id = u.post_id;
+$$;
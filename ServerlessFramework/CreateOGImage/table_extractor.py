@@ -0,0 +1,77 @@
+"""
+post_contentから5W1Hの表（最初の<table>）だけを取り出す
+
+BeautifulSoupで本文全体の木を作る代わりに、最初の<table>の開始位置から標準ライブラリのHTMLParserで読み、
+</table>に達した時点で打ち切る。表がない・閉じタグが欠けているといった崩れたHTMLでも例外にせず、
+読み取れた範囲の{キー: 値}を返す（表がなければ空の辞書）。
+コメントの中の<table>（コメントアウトした古い表など）は開始位置として扱わない。
+"""
+import re
+from html.parser import HTMLParser
+from typing import Dict, Final, List, Optional
+
+
+# コメントを読み飛ばしながら<table>を探す。閉じていないコメントは本文の最後までコメントになる（HTMLParserと同じ）
+TABLE_START_PATTERN: Final[re.Pattern] = re.compile(r"<!--.*?(?:-->|\Z)|(<table\b)", re.IGNORECASE | re.DOTALL)
+
+
+class _TableEnd(Exception):
+    pass
+
+
+class _FirstTableParser(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.cells: List[str] = []
+        self._table_depth = 0
+        self._cell_texts: Optional[List[str]] = None
+
+    def _close_cell(self) -> None:
+        if self._cell_texts is not None:
+            self.cells.append("".join(self._cell_texts))
+            self._cell_texts = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "table":
+            self._table_depth += 1
+        elif tag == "td" and self._table_depth == 1:
+            # 閉じタグのない<td>は次の<td>で閉じる
+            self._close_cell()
+            self._cell_texts = []
+
+    def handle_endtag(self, tag):
+        if tag == "table":
+            self._table_depth -= 1
+            if self._table_depth <= 0:
+                self._close_cell()
+                raise _TableEnd()
+        elif tag in ("td", "tr") and self._table_depth == 1:
+            self._close_cell()
+
+    def handle_data(self, data):
+        # 入れ子の表の中身も外側のセルのテキストとして扱う（BeautifulSoupの.textと同じ）
+        if self._cell_texts is not None:
+            self._cell_texts.append(data)
+
+
+def extract_table_data(post_content: Optional[str]) -> Dict[str, str]:
+    if not post_content:
+        return {}
+    match = next((m for m in TABLE_START_PATTERN.finditer(post_content) if m.group(1)), None)
+    if match is None:
+        return {}
+
+    parser = _FirstTableParser()
+    try:
+        parser.feed(post_content[match.start():])
+        parser.close()
+    except _TableEnd:
+        pass
+    # </table>がないまま本文が終わった場合は、途中のセルも含めて読めた範囲を返す
+    parser._close_cell()
+
+    cells = parser.cells
+    return {
+        cells[2 * i]: cells[2 * i + 1]
+        for i in range(len(cells) // 2)
+    }
@@ -0,0 +1,30 @@
+import logging
+import random
+
+from PIL import Image
+
+from lambda_function import OUTPUT_PROFILES, encode_image
+
+
+def get_noise_image(width: int = 1200, height: int = 630) -> Image.Image:
+    # ノイズはJPEGで圧縮しにくく、下限の品質でも予算を超える
+    rng = random.Random(0)
+    return Image.frombytes("L", (width, height), bytes(rng.getrandbits(8) for _ in range(width * height)))
+
+
+def test_downscales_when_min_quality_is_over_budget(caplog):
+    profile = OUTPUT_PROFILES["jpeg-budget"]
+    with caplog.at_level(logging.INFO):
+        encoded = encode_image(get_noise_image(), profile, post_id=1)
+    assert len(encoded) <= profile.target_bytes
+    assert "downscaled" in caplog.text
+    assert "over the budget" not in caplog.text
+
+
+def test_warns_when_still_over_budget(caplog):
+    profile = OUTPUT_PROFILES["jpeg-budget"]._replace(target_bytes=1_000)
+    with caplog.at_level(logging.INFO):
+        encoded = encode_image(get_noise_image(), profile, post_id=1)
+    assert len(encoded) > profile.target_bytes
+    assert "post_id: 1" in caplog.text
+    assert f"{len(encoded)} bytes, over the budget of {profile.target_bytes} bytes" in caplog.text
@@ -0,0 +1,29 @@
+from table_extractor import extract_table_data
+
+
+TABLE = "<table><tr><td>Who(誰が)</td><td>私</td></tr><tr><td>Then(どうした)</td><td>謝った</td></tr></table>"
+EXPECTED = {"Who(誰が)": "私", "Then(どうした)": "謝った"}
+
+
+def test_extracts_first_table():
+    assert extract_table_data(f"<p>本文</p>{TABLE}<table><tr><td>a</td><td>b</td></tr></table>") == EXPECTED
+
+
+def test_returns_empty_without_table():
+    assert extract_table_data("<p>本文</p>") == {}
+    assert extract_table_data(None) == {}
+
+
+def test_skips_table_in_comment():
+    # コメントアウトした表の<table>から読み始め、本来の表を入れ子の表として読み飛ばしていた
+    post_content = f"<!-- <table><tr><td>古い</td><td>表</td></tr></table> --><p>本文</p>{TABLE}"
+    assert extract_table_data(post_content) == EXPECTED
+
+
+def test_skips_comment_inside_table():
+    post_content = TABLE.replace("<tr><td>Then", "<!-- <tr><td>When(いつ)</td><td>昨日</td></tr> --><tr><td>Then")
+    assert extract_table_data(post_content) == EXPECTED
+
+
+def test_returns_empty_when_only_table_is_commented_out():
+    assert extract_table_data(f"<p>本文</p><!-- {TABLE}") == {}
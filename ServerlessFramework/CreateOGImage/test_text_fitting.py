@@ -0,0 +1,26 @@
+from PIL import ImageFont
+
+from text_fitting import ELLIPSIS, TextFitter
+
+
+def get_fitter() -> TextFitter:
+    # リポジトリにフォントファイルを含めていないため、Pillowに同梱されているフォントを使う
+    return TextFitter(ImageFont.load_default(size=30))
+
+
+def test_truncates_when_space_overflows_line():
+    # 行からあふれる単位が空白の場合に、残りのテキストが省略記号なしで消えていた
+    fitter = get_fitter()
+    max_width = fitter.text_width("aaaa aaaa") + 3
+    fitted = fitter.fit("aaaa aaaa bbbb cccc dddd", max_width, max_lines=1)
+    assert fitted.truncated
+    assert len(fitted.lines) == 1
+    assert fitted.lines[0].endswith(ELLIPSIS)
+
+
+def test_wraps_without_leading_space():
+    fitter = get_fitter()
+    max_width = fitter.text_width("aaaa aaaa") + 3
+    fitted = fitter.fit("aaaa aaaa bbbb", max_width, max_lines=2)
+    assert fitted.lines == ["aaaa aaaa", "bbbb"]
+    assert not fitted.truncated
@@ -0,0 +1,122 @@
+"""
+OG画像のコンテンツセル向けのテキスト配置
+
+- 文字ごとの送り幅（advance width）をキャッシュし、ピクセル単位で折り返し位置を決める
+- 日本語は文字単位、英数字は単語単位で折り返し、簡易的な行頭・行末禁則を行う
+- 行数に収まらない場合は、省略記号が収まる位置を累積幅の二分探索で求めて切り詰める
+- 行の高さはフォントごとに一度だけ測り、折り返しとブロックの高さを一度に返す
+"""
+import bisect
+import itertools
+import re
+from typing import Dict, Final, List, NamedTuple
+
+from PIL import Image, ImageDraw, ImageFont
+
+
+ELLIPSIS: Final[str] = "..."
+# 行頭に置かない文字
+NO_LINE_START: Final[str] = "、。，．・：；？！ー―…‥）」』】〕〉》｝］)]}!,.:;?’”ぁぃぅぇぉっゃゅょゎァィゥェォッャュョヮヵヶ"
+# 行末に置かない文字
+NO_LINE_END: Final[str] = "（「『【〔〈《｛［([{‘“"
+# 英数字と記号の連続は単語として分割しない
+ASCII_WORD_PATTERN: Final[re.Pattern] = re.compile(r"[!-~]+| |.", re.DOTALL)
+WHITESPACE_PATTERN: Final[re.Pattern] = re.compile(r"\s+")
+
+
+class FittedText(NamedTuple):
+    lines: List[str]
+    height: int
+    truncated: bool
+
+
+class TextFitter:
+    def __init__(self, font: ImageFont.FreeTypeFont):
+        self.font = font
+        self._advances: Dict[str, float] = {}
+        self._ellipsis_width = self.text_width(ELLIPSIS)
+
+        # 1行の高さと行送りはフォントごとに一度だけ測る
+        draw = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+        single_bbox = draw.textbbox((0, 0), "あ", font=font)
+        double_bbox = draw.multiline_textbbox((0, 0), "あ\nあ", font=font)
+        self.line_height = single_bbox[3] - single_bbox[1]
+        self.line_advance = (double_bbox[3] - double_bbox[1]) - self.line_height
+
+    def advance(self, char: str) -> float:
+        width = self._advances.get(char)
+        if width is None:
+            width = self.font.getlength(char)
+            self._advances[char] = width
+        return width
+
+    def text_width(self, text: str) -> float:
+        return sum(self.advance(char) for char in text)
+
+    def block_height(self, line_count: int) -> int:
+        if line_count == 0:
+            return 0
+        return self.line_height + (line_count - 1) * self.line_advance
+
+    def _split_units(self, text: str, max_width: float) -> List[str]:
+        units = []
+        for unit in ASCII_WORD_PATTERN.findall(text):
+            # 1行に収まらない長い英単語やURLは文字単位で分割する
+            if len(unit) > 1 and self.text_width(unit) > max_width:
+                units.extend(unit)
+            else:
+                units.append(unit)
+        return units
+
+    def _wrap(self, text: str, max_width: float, max_lines: int) -> List[List[str]]:
+        # max_lines + 1行目が作られた時点で打ち切る（それ以上は切り詰められるため）
+        lines: List[List[str]] = [[]]
+        line_width = 0.0
+        for unit in self._split_units(text, max_width):
+            unit_width = self.text_width(unit)
+            current = lines[-1]
+            if line_width + unit_width <= max_width or not current:
+                if unit == " " and not current:
+                    continue
+                current.append(unit)
+                line_width += unit_width
+                continue
+            if unit == " ":
+                # 空白では改行しない（空の行ができて切り詰めが検出されなくなる）。次の単位で改行する
+                line_width = float("inf")
+                continue
+
+            carried: List[str] = []
+            # 禁則処理：行頭禁則文字の前、行末禁則文字は次の行へ送る
+            if (
+                len(current) > 1
+                and (unit[0] in NO_LINE_START or current[-1][-1] in NO_LINE_END)
+                and self.text_width(current[-1]) + unit_width <= max_width
+            ):
+                carried.append(current.pop())
+            while current and current[-1] == " ":
+                current.pop()
+            carried.append(unit)
+            lines.append(carried)
+            if len(lines) > max_lines:
+                break
+            line_width = sum(self.text_width(carried_unit) for carried_unit in carried)
+        return [line for line in lines if line]
+
+    def _truncate(self, line: str, max_width: float) -> str:
+        # 累積幅を二分探索し、省略記号を付けても収まる最長の先頭部分を求める
+        cumulative_widths = list(itertools.accumulate(self.advance(char) for char in line))
+        end = bisect.bisect_right(cumulative_widths, max_width - self._ellipsis_width)
+        return line[:end].rstrip(" " + NO_LINE_END) + ELLIPSIS
+
+    def fit(self, text: str, max_width: float, max_lines: int) -> FittedText:
+        text = WHITESPACE_PATTERN.sub(" ", text).strip()
+        if not text:
+            return FittedText([], 0, False)
+
+        wrapped = self._wrap(text, max_width, max_lines)
+        lines = ["".join(line) for line in wrapped[:max_lines]]
+        truncated = len(wrapped) > max_lines
+        if truncated:
+            lines[-1] = self._truncate(lines[-1], max_width)
+        return FittedText(lines, self.block_height(len(lines)), truncated)
@@ -1,15 +1,15 @@
 import dlt
+import logging
 from sqlalchemy import create_engine, text
 from concurrent.futures import ThreadPoolExecutor
 from time import time
-import boto3
-import json
+from hpe_runtime import get_client, get_secret, log_cache_stats
 BQ_DATASET = "hpe_raw"
 
+logger = logging.getLogger()
+
 def get_secrets():
-    secretmanager_client = boto3.client("secretsmanager")
-    secret_value = secretmanager_client.get_secret_value(SecretId="DLT_CONNECTION_PARAMS")
-    return json.loads(secret_value["SecretString"])
+    return get_secret("DLT_CONNECTION_PARAMS")
 
 
 def process_table(table_name, engine, secrets):
@@ -43,9 +43,12 @@ def process_table(table_name, engine, secrets):
 def lambda_handler(event, context):
     secrets = get_secrets()
     connection_string = secrets["connection_string"]
-    engine = create_engine(
-        connection_string,
-        connect_args={"connect_timeout": 60 * 15}
+    engine = get_client(
+        ("sqlalchemy", connection_string),
+        lambda: create_engine(
+            connection_string,
+            connect_args={"connect_timeout": 60 * 15}
+        ),
     )
 
     with engine.connect() as conn:
@@ -53,6 +56,8 @@ def lambda_handler(event, context):
         table_names = [row[0] for row in res]
     with ThreadPoolExecutor() as executor:
         executor.map(lambda table_name: process_table(table_name, engine, secrets), table_names)
+    logger.setLevel("INFO")
+    log_cache_stats(logger)
 
 if __name__ == "__main__":
     lambda_handler(None, None)
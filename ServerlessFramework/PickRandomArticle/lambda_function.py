@@ -1,19 +1,13 @@
 import json
-from supabase import create_client
-import boto3
+from hpe_runtime import get_boto3_client, get_secret, get_supabase_client, log_cache_stats
 from logging import getLogger
 
 logger = getLogger()
 logger.setLevel("INFO")
 
 
-def get_secret():
-    secretmanager = boto3.client('secretsmanager')
-    secret = secretmanager.get_secret_value(SecretId='SUPABASE_CONNECTION_SECRET')
-    return json.loads(secret['SecretString'])
-
-def get_supabase_client(secret):
-    return create_client(secret['SUPABASE_URL'], secret['SUPABASE_SERVICE_ROLE_KEY'])
+def get_supabase_secret():
+    return get_secret('SUPABASE_CONNECTION_SECRET')
 
 def get_random_article(supabase):
     articles = supabase.table('dim_posts') \
@@ -34,17 +28,18 @@ def publish_to_sns(article):
         "og_url": article['ogp_image_url'],
         "message_type": "random"
     }
-    sns = boto3.client('sns')
+    sns = get_boto3_client('sns')
     sns.publish(TopicArn='arn:aws:sns:ap-northeast-1:662924458234:healthy-person-emulator-socialpost', Message=json.dumps(message))
 
 def lambda_handler(event, context):
     try:    
-        secret = get_secret()
+        secret = get_supabase_secret()
         supabase = get_supabase_client(secret)
         article = get_random_article(supabase)
         update_sns_pickuped(supabase, article['post_id'])
         publish_to_sns(article)
         logger.info(f"Article {article['post_id']} picked up")
+        log_cache_stats(logger)
     except Exception as e:
         logger.error(e)
         raise e
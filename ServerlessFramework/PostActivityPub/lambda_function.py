@@ -1,80 +1,28 @@
-from misskey import Misskey
 import json
-import boto3
-import httpx
+from hpe_runtime import log_cache_stats
+from hpe_runtime.image_fetch import fetch_image
+from hpe_runtime.sns_batch import handle_batch
+from hpe_runtime.social import parse_message, send_social_post_id
+from hpe_runtime.social import misskey
 import logging
 
 logger = logging.getLogger()
 
-
-tmp_file_path = "/tmp/og_image.jpg"
-
-def get_misskey_secret():
-    secretmanager_client = boto3.client("secretsmanager")
-    secret_value = secretmanager_client.get_secret_value(SecretId="MISSKEY_TOKEN")
-    secrets = json.loads(secret_value["SecretString"])
-    misskey_token = secrets["MISSKEY_IO_TOKEN"]
-    return misskey_token
-
-def download_image(url):
-    response = httpx.get(url).content
-    with open(tmp_file_path, "wb") as f:
-        f.write(response)
-
-def upload_image_to_misskey(mk):
-    with open(tmp_file_path, "rb") as f:
-        data = mk.drive_files_create(f)
-    return data["id"]
-
-def create_post_text(post_title, post_url, message_type):
-    type_prefix = {
-        "new": "新規記事",
-        "legendary": "殿堂入り",
-        "random": "ランダム"
-    }
-    if message_type not in type_prefix:
-        raise ValueError("Unknown message type")
-    
-    return f"[{type_prefix[message_type]}] : {post_title} 健常者エミュレータ事例集\n{post_url}"
-
-def post_note_to_misskey(post_text, uploaded_file_id, mk) -> str:
-    note = mk.notes_create(
-        text=post_text,
-        file_ids=[uploaded_file_id],
-    )
-    note_id = note["createdNote"]["id"]
+def post_message(raw_message):
+    message = parse_message(raw_message)
+    print(f"Message is {message}")
+    image_bytes = fetch_image(message.og_url)
+    note_id = misskey.post(message, image_bytes)
+    send_social_post_id(message.post_id, note_id, "misskey")
+    logger.setLevel("INFO")
+    logger.info(f"post_title: {message.post_title} is successfully posted.")
     return note_id
 
-
-def get_infomation_from_message(message):
-    post_title = message["post_title"]
-    post_url = message["post_url"]
-    og_url = message["og_url"]
-    message_type = message["message_type"]
-    post_id = message["post_id"]
-    return post_title, post_url, og_url, message_type, post_id
-
-def send_event_to_sns(post_id, social_post_id):
-    sns_client = boto3.client("sns")
-    sns_client.publish(
-        TopicArn="arn:aws:sns:ap-northeast-1:662924458234:healthy-person-emulator-socialpostIds",
-        Message=json.dumps({"post_id": post_id, "social_post_id": social_post_id, "social_type": "misskey"})
-    )
-
 def lambda_handler(event, context):
     try:
-        message = json.loads(event["Records"][0]["Sns"]["Message"])
-        print(f"Message is {message}")
-        post_title, post_url, og_url, message_type, post_id = get_infomation_from_message(message)
-        misskey_secret = get_misskey_secret()
-        mk = Misskey('https://misskey.io', i = misskey_secret)
-        download_image(og_url)
-        uploaded_file_id = upload_image_to_misskey(mk)
-        post_text = create_post_text(post_title, post_url, message_type)
-        note_id = post_note_to_misskey(post_text, uploaded_file_id, mk)
-        send_event_to_sns(post_id, note_id)
-        logger.setLevel("INFO")
-        logger.info(f"post_title: {post_title} is successfully posted.")
+        response = handle_batch(event, post_message)
+        log_cache_stats(logger)
+        return response
     except Exception as e:
         logger.setLevel("ERROR")
         logger.error(e)
@@ -86,7 +34,7 @@ if __name__ == "__main__":
         "Records": [
             {
                 "Sns": {
-                    "Message":json.dumps(
+                    "Message": json.dumps(
                         {
                             "post_title": "無神論者の火",
                             "post_url": "https://healthy-person-emulator.org/archives/23576",
@@ -99,4 +47,4 @@ if __name__ == "__main__":
             }
         ]
     }
-    lambda_handler(test_event, None)
\ No newline at end of file
+    lambda_handler(test_event, None)
@@ -1,88 +1,30 @@
-from atproto import Client, models
-import requests
 import json
-import boto3
+from hpe_runtime import log_cache_stats
+from hpe_runtime.image_fetch import fetch_image
+from hpe_runtime.sns_batch import handle_batch
+from hpe_runtime.social import parse_message, send_social_post_id
+from hpe_runtime.social import bluesky
 from logging import getLogger
 
 logger = getLogger()
 
-def download_image(s3_url):
-    response = requests.get(s3_url).content
-    return response
-
-def get_bluesky_credentials():
-    secretmanager_client = boto3.client("secretsmanager")
-    secret_value = secretmanager_client.get_secret_value(SecretId="hpe-bluesky-bot-tokens")
-    secrets = json.loads(secret_value["SecretString"])
-    return secrets
-
-def create_post_text(post_title, message_type):
-    if message_type == "new":
-        text = f"【新規記事】 : {post_title}"
-    elif message_type == "legendary":
-        text = f"【殿堂入り】 : {post_title}"
-    elif message_type == "random":
-        text = f"【ランダム】 : {post_title}"
-    else:
-        raise ValueError("Unknown message type")
-    return text
-
-def get_message(event):
-    if type(event["Records"][0]["Sns"]["Message"]) == str:
-        message = json.loads(event["Records"][0]["Sns"]["Message"])
-    elif type(event["Records"][0]["Sns"]["Message"]) == dict:
-        message = event["Records"][0]["Sns"]["Message"]
-    else:
-        raise ValueError("Message type is not str or dict")
-    return message
-
-def get_infomation_from_message(message):
-    post_title = message["post_title"]
-    post_url = message["post_url"]
-    og_url = message["og_url"]
-    message_type = message["message_type"]
-    post_id = message["post_id"]
-    return post_title, post_url, og_url, message_type, post_id
-
-def send_event_to_sns(post_id, social_post_id):
-    sns_client = boto3.client("sns")
-    sns_client.publish(
-        TopicArn="arn:aws:sns:ap-northeast-1:662924458234:healthy-person-emulator-socialpostIds",
-        Message=json.dumps({"post_id": post_id, "social_post_id": social_post_id, "social_type": "bluesky"})
-    )
+def post_message(raw_message):
+    message = parse_message(raw_message)
+    image_data = fetch_image(message.og_url)
+    bluesky_post_uri = bluesky.post(message, image_data)
+    send_social_post_id(message.post_id, bluesky_post_uri, "bluesky")
+    logger.info(f"post_title: {message.post_title} is successfully posted to BlueSky. post_uri: {bluesky_post_uri}")
+    return bluesky_post_uri
 
 def lambda_handler(event, context):
     try:
-        message = get_message(event)
-        post_title, post_url, og_url, message_type, post_id = get_infomation_from_message(message)
-
-        secrets = get_bluesky_credentials()
-
-        image_data = download_image(og_url)
-        bluesky_client = Client(base_url='https://bsky.social')
-        bluesky_client.login(secrets["useraddress"], secrets["password"])
-
-        thumbnail = bluesky_client.upload_blob(image_data)
-
-        post_text = create_post_text(post_title, message_type)
-
-        embed = models.AppBskyEmbedExternal.Main(
-            external=models.AppBskyEmbedExternal.External(
-                title=post_title,
-                uri=post_url,
-                thumb=thumbnail.blob,
-                description="",
-            )
-        )
-
-        post = bluesky_client.send_post(text=post_text,embed=embed)
-        bluesky_post_uri = post.uri
-        send_event_to_sns(post_id, bluesky_post_uri)
-        logger.info(f"post_title: {post_title} is successfully posted to BlueSky. post_uri: {bluesky_post_uri}")
+        response = handle_batch(event, post_message)
+        log_cache_stats(logger)
+        return response
     except Exception as e:
         logger.error(f"Error: {e}")
         raise e
-    
+
 if __name__ == "__main__":
     test_event = {
         "Records": [
@@ -101,4 +43,4 @@ if __name__ == "__main__":
             }
         ]
     }
-    lambda_handler(test_event, None)
\ No newline at end of file
+    lambda_handler(test_event, None)
@@ -0,0 +1,105 @@
+"""
+新規記事などのSNS投稿をまとめて行う
+
+socialpostトピックのメッセージを受け取り、OG画像を一度だけ取得して、Twitter・Bluesky・Misskeyへ並行して投稿する。
+プラットフォームごとの失敗は他の投稿に影響させず、投稿できたIDはまとめてsocialpostIdsトピックへ送る。
+"""
+import asyncio
+import functools
+import json
+import logging
+import time
+from typing import Callable, Dict, Final, Optional, Union
+
+from hpe_runtime import log_cache_stats
+from hpe_runtime.image_fetch import fetch_image
+from hpe_runtime.sns_batch import handle_batch
+from hpe_runtime.social import SocialPostMessage, parse_message, send_social_post_ids
+from hpe_runtime.social import bluesky, misskey, twitter
+from hpe_runtime.tweet_scheduler import deadline_from_context
+
+logger = logging.getLogger()
+
+PLATFORMS: Final[Dict[str, Callable[[SocialPostMessage, bytes], str]]] = {
+    "twitter": twitter.post,
+    "bluesky": bluesky.post,
+    "misskey": misskey.post,
+}
+
+
+async def post_to_platform(social_type: str, message: SocialPostMessage, image_bytes: bytes,
+                           deadline: Optional[float] = None) -> str:
+    post = PLATFORMS[social_type]
+    if social_type == "twitter":
+        # Twitterはレート制限のリセットまで待つため、Lambdaが終了する前に諦める期限を渡す
+        post = functools.partial(post, deadline=deadline)
+    start = time.perf_counter()
+    social_post_id = await asyncio.to_thread(post, message, image_bytes)
+    logger.setLevel("INFO")
+    logger.info(f"{social_type}: posted in {time.perf_counter() - start:.2f}s. social_post_id: {social_post_id}")
+    return social_post_id
+
+
+async def post_to_all_platforms(message: SocialPostMessage, image_bytes: bytes,
+                                deadline: Optional[float] = None) -> Dict[str, Union[str, BaseException]]:
+    # 1つのプラットフォームの失敗で他の投稿を止めないよう、例外も結果として受け取る
+    results = await asyncio.gather(
+        *(post_to_platform(social_type, message, image_bytes, deadline) for social_type in PLATFORMS),
+        return_exceptions=True,
+    )
+    return dict(zip(PLATFORMS, results))
+
+
+def post_message(raw_message: str, deadline: Optional[float] = None) -> Dict[str, str]:
+    message = parse_message(raw_message)
+    image_bytes = fetch_image(message.og_url)
+    results = asyncio.run(post_to_all_platforms(message, image_bytes, deadline))
+
+    social_post_ids = {social_type: result for social_type, result in results.items() if not isinstance(result, BaseException)}
+    failures = {social_type: result for social_type, result in results.items() if isinstance(result, BaseException)}
+    for social_type, error in failures.items():
+        logger.setLevel("ERROR")
+        logger.error(f"{social_type}: failed to post {message.post_title}. {error!r}")
+
+    try:
+        send_social_post_ids(message.post_id, social_post_ids)
+    except Exception as e:
+        # 投稿は済んでいるため、ここで失敗させると再試行で二重投稿になる。IDはログから復旧する
+        logger.setLevel("ERROR")
+        logger.error(f"Failed to publish social_post_ids. post_id: {message.post_id}, social_post_ids: {social_post_ids}. {e!r}")
+    logger.setLevel("INFO")
+    logger.info(f"post_title: {message.post_title} is posted to {sorted(social_post_ids)}.")
+
+    # 一部でも投稿できていれば再試行しない（再試行すると投稿済みのプラットフォームに二重投稿される）
+    if not social_post_ids:
+        raise RuntimeError(f"Failed to post to all platforms: {failures}")
+    return social_post_ids
+
+
+def lambda_handler(event, context):
+    # 複数の記事が届いた場合は記事ごとに並行して投稿し、失敗した記事だけを再試行させる
+    deadline = deadline_from_context(context)
+    response = handle_batch(event, lambda raw_message: post_message(raw_message, deadline))
+    log_cache_stats(logger)
+    return response
+
+
+if __name__ == "__main__":
+    test_event = {
+        "Records": [
+            {
+                "Sns": {
+                    "Message": json.dumps(
+                        {
+                            "post_title": "無神論者の火",
+                            "post_url": "https://healthy-person-emulator.org/archives/23576",
+                            "og_url": "https://healthy-person-emulator-public-assets.s3-ap-northeast-1.amazonaws.com/23576.jpg",
+                            "message_type": "new",
+                            "post_id": 23576
+                        }
+                    )
+                }
+            }
+        ]
+    }
+    lambda_handler(test_event, None)
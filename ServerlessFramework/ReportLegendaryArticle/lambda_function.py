@@ -1,22 +1,26 @@
 from google.cloud import bigquery
-import boto3
-import json
 from google.oauth2 import service_account
-import tweepy
-from supabase import create_client
+from hpe_runtime import get_client, get_secret, get_supabase_client, log_cache_stats
+from hpe_runtime.tweet_scheduler import deadline_from_context, get_tweet_scheduler
 import logging
 
 logger = logging.getLogger()
 
+LEGENDARY_TAG_ID = 575
+
 def get_bigquery_credentials():
-    secretmanager_client = boto3.client("secretsmanager")
-    secret_value = secretmanager_client.get_secret_value(SecretId="BIGQUERY_ACCESS_CREDENTIAL")
-    secrets = json.loads(secret_value["SecretString"])
-    credentials = service_account.Credentials.from_service_account_info(secrets)
-    return credentials
+    secrets = get_secret("BIGQUERY_ACCESS_CREDENTIAL")
+    return get_client(
+        ("bigquery_credentials", secrets["client_email"], secrets["private_key_id"]),
+        lambda: service_account.Credentials.from_service_account_info(secrets),
+    )
 
 def get_legendary_article_data(credentials):
-    client = bigquery.Client(credentials=credentials)
+    # 認証情報のオブジェクトは実行ごとに変わりうるため、プロジェクトとサービスアカウントをキーにする
+    client = get_client(
+        ("bigquery", credentials.project_id, credentials.service_account_email),
+        lambda: bigquery.Client(credentials=credentials, project=credentials.project_id),
+    )
     query = """
         SELECT
             *
@@ -35,55 +39,64 @@ def get_legendary_article_data(credentials):
     return ans
 
 def get_supabase_credentials():
-    secretmanager_client = boto3.client("secretsmanager")
-    secret_value = secretmanager_client.get_secret_value(SecretId="SUPABASE_CONNECTION_SECRET")
-    secrets = json.loads(secret_value["SecretString"])
-    return secrets
+    return get_secret("SUPABASE_CONNECTION_SECRET")
+
+def get_tagged_post_ids(legendary_article_data, secrets):
+    # 殿堂入りタグが付いている記事はツイート済みなので、再実行やBigQueryの反映遅れで二重にツイートしない
+    if not legendary_article_data:
+        return set()
+    client = get_supabase_client(secrets)
+    response = client.table("rel_post_tags").select("post_id") \
+        .eq("tag_id", LEGENDARY_TAG_ID) \
+        .in_("post_id", [article["post_id"] for article in legendary_article_data]) \
+        .execute()
+    return {row["post_id"] for row in response.data}
 
 def update_supabase(legendary_article_data, secrets):
-    client = create_client(secrets["SUPABASE_URL"], secrets["SUPABASE_SERVICE_ROLE_KEY"])
-    for article in legendary_article_data:
-        try:
-            response = client.table("rel_post_tags").insert({"post_id": article["post_id"], "tag_id": 575}).execute()
-        except Exception as e:
-            print(e)
-            raise e
+    # ツイートできた記事だけにタグを付ける（付いていない記事は次回の実行で再びツイートされる）
+    if not legendary_article_data:
+        return
+    client = get_supabase_client(secrets)
+    try:
+        client.table("rel_post_tags").insert([
+            {"post_id": article["post_id"], "tag_id": LEGENDARY_TAG_ID}
+            for article in legendary_article_data
+        ]).execute()
+    except Exception as e:
+        print(e)
+        raise e
 
 
 def get_twitter_credentials():
-    secretmanager_client = boto3.client("secretsmanager")
-    secret_value = secretmanager_client.get_secret_value(SecretId="hpe-twitter-bot-tokens")
-    secrets = json.loads(secret_value["SecretString"])
-    return secrets
-
-def post_tweet(legendary_article_data, secrets):
-    for article in legendary_article_data:
-        title = article["post_title"]
-        url = article["post_url"]
-        text = f"[殿堂入り] : {title} 健常者エミュレータ事例集 \n{url}"
-        consumer_key = secrets["CK"]
-        consumer_secret = secrets["CS"]
-        access_token = secrets["AT"]
-        access_token_secret = secrets["ATS"]
+    return get_secret("hpe-twitter-bot-tokens")
 
-        client = tweepy.Client(
-            consumer_key=consumer_key,
-            consumer_secret=consumer_secret,
-            access_token=access_token,
-            access_token_secret=access_token_secret,
-        )
-        client.create_tweet(text=text)
+def post_tweet(legendary_article_data, secrets, deadline=None):
+    # レート制限に達した場合はリセットを待って、すべての記事を順番にツイートする
+    texts = [
+        f"[殿堂入り] : {article['post_title']} 健常者エミュレータ事例集 \n{article['post_url']}"
+        for article in legendary_article_data
+    ]
+    return get_tweet_scheduler(secrets).post_all(texts, deadline)
 
 def lambda_handler(event, context):
     try:
         bigquery_credentials = get_bigquery_credentials()
         legendary_article_data = get_legendary_article_data(bigquery_credentials)
         supabase_credentials = get_supabase_credentials()
-        update_supabase(legendary_article_data, supabase_credentials)
+        tagged_post_ids = get_tagged_post_ids(legendary_article_data, supabase_credentials)
+        untweeted_articles = [article for article in legendary_article_data if article["post_id"] not in tagged_post_ids]
         twitter_credentials = get_twitter_credentials()
-        post_tweet(legendary_article_data, twitter_credentials)
+        results = post_tweet(untweeted_articles, twitter_credentials, deadline_from_context(context))
+        tweeted_articles = [article for article, result in zip(untweeted_articles, results) if result.error is None]
+        update_supabase(tweeted_articles, supabase_credentials)
         logger.setLevel("INFO")
-        logger.info(f"Legendary articles are successfully updated.{len(legendary_article_data)} articles.")
+        logger.info(f"Legendary articles are successfully updated.{len(legendary_article_data)} articles. "
+                    f"{len(tagged_post_ids)} already tweeted. {len(tweeted_articles)} tweeted.")
+        log_cache_stats(logger)
+        # ツイートできなかった記事は未タグのまま残し、再実行でその記事だけをツイートする
+        failures = [result for result in results if result.error is not None]
+        if failures:
+            raise RuntimeError(f"Failed to tweet {len(failures)} legendary articles: {failures[0].error!r}")
     except Exception as e:
         logger.setLevel("ERROR")
         logger.error(e)
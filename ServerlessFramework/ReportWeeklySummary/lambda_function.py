@@ -1,18 +1,24 @@
 from google.cloud import bigquery
-import boto3
-import json
 from google.oauth2 import service_account
-import tweepy
+from hpe_runtime import get_client, get_secret, log_cache_stats
+from hpe_runtime.tweet_scheduler import deadline_from_context, get_tweet_scheduler
+import logging
+
+logger = logging.getLogger()
 
 def get_credentials():
-    secretmanager_client = boto3.client("secretsmanager")
-    secret_value = secretmanager_client.get_secret_value(SecretId="BIGQUERY_ACCESS_CREDENTIAL")
-    secrets = json.loads(secret_value["SecretString"])
-    credentials = service_account.Credentials.from_service_account_info(secrets)
-    return credentials
+    secrets = get_secret("BIGQUERY_ACCESS_CREDENTIAL")
+    return get_client(
+        ("bigquery_credentials", secrets["client_email"], secrets["private_key_id"]),
+        lambda: service_account.Credentials.from_service_account_info(secrets),
+    )
 
 def get_weekly_summary_data(credentials):
-    client = bigquery.Client(credentials=credentials)
+    # 認証情報のオブジェクトは実行ごとに変わりうるため、プロジェクトとサービスアカウントをキーにする
+    client = get_client(
+        ("bigquery", credentials.project_id, credentials.service_account_email),
+        lambda: bigquery.Client(credentials=credentials, project=credentials.project_id),
+    )
     query = """
         SELECT
             *
@@ -44,32 +50,21 @@ def create_tweet_text(weekly_summary_data):
     return tweet_text
 
 def get_twitter_credentials():
-    secretmanager_client = boto3.client("secretsmanager")
-    secret_value = secretmanager_client.get_secret_value(SecretId="hpe-twitter-bot-tokens")
-    secrets = json.loads(secret_value["SecretString"])
-    return secrets
+    return get_secret("hpe-twitter-bot-tokens")
 
-def post_tweet(tweet_text):
+def post_tweet(tweet_text, deadline=None):
     secrets = get_twitter_credentials()
-    consumer_key = secrets["CK"]
-    consumer_secret = secrets["CS"]
-    access_token = secrets["AT"]
-    access_token_secret = secrets["ATS"]
-    client = tweepy.Client(
-        consumer_key=consumer_key,
-        consumer_secret=consumer_secret,
-        access_token=access_token,
-        access_token_secret=access_token_secret,
-    )
-
-    client.create_tweet(text=tweet_text)
+    get_tweet_scheduler(secrets).create_tweet(tweet_text, deadline)
 
 def lambda_handler(event, context):
     try:
         credentials = get_credentials()
         weekly_summary_data = get_weekly_summary_data(credentials)
         tweet_text = create_tweet_text(weekly_summary_data)
-        post_tweet(tweet_text)
+        post_tweet(tweet_text, deadline_from_context(context))
+        logger.setLevel("INFO")
+        logger.info("Weekly summary is successfully tweeted.")
+        log_cache_stats(logger)
     except Exception as e:
         raise e
 
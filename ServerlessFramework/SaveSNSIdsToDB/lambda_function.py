@@ -1,49 +1,67 @@
-import boto3
 import json
 import logging
-import supabase
+import threading
+from hpe_runtime import get_secret, get_supabase_client, log_cache_stats
+from hpe_runtime.sns_batch import process_records, raise_for_failures, to_batch_response
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+SOCIAL_ID_COLUMNS = {
+    "twitter": "tweet_id_of_first_tweet",
+    "bluesky": "bluesky_post_uri_of_first_post",
+    "misskey": "misskey_note_id_of_first_note",
+}
+
 def get_message(message):
-    post_id = message["post_id"]
-    social_type = message["social_type"]
-    social_post_id = message["social_post_id"]
-    return post_id, social_type, social_post_id
+    # {"post_id", "social_post_ids": {social_type: social_post_id}}（hpe_runtime.social.send_social_post_ids）
+    return message["post_id"], dict(message["social_post_ids"])
 
 def get_credentials_of_db():
-    secretmanager_client = boto3.client("secretsmanager")
-    secret_value = secretmanager_client.get_secret_value(SecretId="SUPABASE_CONNECTION_SECRET")
-    secrets = json.loads(secret_value["SecretString"])
-    return secrets
-
-def save_sns_ids_to_db(post_id, social_type, social_post_id):
-    credentials_of_db = get_credentials_of_db()
-    client = supabase.create_client(credentials_of_db["SUPABASE_URL"], credentials_of_db["SUPABASE_SERVICE_ROLE_KEY"])
-    try:
-        if social_type == "twitter":
-            client.table("dim_posts").update({"tweet_id_of_first_tweet": social_post_id}).eq("post_id", post_id).execute()
-            logger.info(f"tweet_id is saved to db. post_id: {post_id}, tweet_id: {social_post_id}")
-        elif social_type == "bluesky":
-            client.table("dim_posts").update({"bluesky_post_uri_of_first_post": social_post_id}).eq("post_id", post_id).execute()
-            logger.info(f"bluesky_post_uri is saved to db. post_id: {post_id}, bluesky_post_uri: {social_post_id}")
-        elif social_type == "misskey":
-            client.table("dim_posts").update({"misskey_note_id_of_first_note": social_post_id}).eq("post_id", post_id).execute()
-            logger.info(f"misskey_note_id is saved to db. post_id: {post_id}, misskey_note_id: {social_post_id}")
-    except Exception as e:
-        logger.error(e)
-        raise e
-    return
+    return get_secret("SUPABASE_CONNECTION_SECRET")
+
+class SocialPostIdBuffer:
+    # バッチ内のメッセージをpost_idごとに1行へまとめ、まとめて1回で書き込む
+    def __init__(self):
+        self.rows = {}
+        self._lock = threading.Lock()
+
+    def add(self, post_id, social_post_ids):
+        with self._lock:
+            row = self.rows.setdefault(post_id, {"post_id": post_id})
+            for social_type, social_post_id in social_post_ids.items():
+                if social_type not in SOCIAL_ID_COLUMNS:
+                    logger.warning(f"Unknown social_type: {social_type}. post_id: {post_id}")
+                    continue
+                row[SOCIAL_ID_COLUMNS[social_type]] = social_post_id
+
+    def add_message(self, raw_message):
+        post_id, social_post_ids = get_message(json.loads(raw_message))
+        self.add(post_id, social_post_ids)
+        return post_id
+
+    def flush(self):
+        # 関数の定義はsql/save_social_post_ids.sqlを参照
+        with self._lock:
+            rows = [row for row in self.rows.values() if len(row) > 1]
+            self.rows = {}
+        if not rows:
+            return 0
+        client = get_supabase_client(get_credentials_of_db())
+        updated = client.rpc("save_social_post_ids", {"updates": rows}).execute().data
+        logger.info(f"sns_ids are saved to db. {len(rows)} posts, {updated} rows updated. rows: {rows}")
+        return updated
 
 def lambda_handler(event, context):
     try:
-        message = json.loads(event["Records"][0]["Sns"]["Message"])
-        post_id, social_type, social_post_id = get_message(message)
-        save_sns_ids_to_db(post_id, social_type, social_post_id)
-        logger.info(f"sns_ids are saved to db. post_id: {post_id}, social_type: {social_type}, social_post_id: {social_post_id}")
+        # 読み取れないメッセージだけを失敗として返し、書き込みに失敗した場合はバッチ全体を再試行させる
+        buffer = SocialPostIdBuffer()
+        results = process_records(event, buffer.add_message)
+        buffer.flush()
+        log_cache_stats(logger)
+        raise_for_failures(event, results)
     except Exception as e:
         print(e)
         logger.error(e)
         raise e
-    return
+    return to_batch_response(results)
@@ -0,0 +1,22 @@
+-- SaveSNSIdsToDBがSNSの投稿IDをまとめて保存するための定義
+-- Supabaseのダッシュボード（SQL Editor）で実行する
+
+-- post_idごとにまとめたSNSの投稿IDを1回で保存し、更新した行数を返す
+-- 含まれていない（nullの）IDは既存の値を残す
+-- updates: [{"post_id": 1, "tweet_id_of_first_tweet": "...", "bluesky_post_uri_of_first_post": "...", "misskey_note_id_of_first_note": null}, ...]
+create or replace function save_social_post_ids(updates jsonb)
+returns integer
+language sql
+as $$
+  with updated as (
+    update dim_posts as d
+    set tweet_id_of_first_tweet = coalesce(u.tweet_id_of_first_tweet, d.tweet_id_of_first_tweet),
+        bluesky_post_uri_of_first_post = coalesce(u.bluesky_post_uri_of_first_post, d.bluesky_post_uri_of_first_post),
+        misskey_note_id_of_first_note = coalesce(u.misskey_note_id_of_first_note, d.misskey_note_id_of_first_note)
+    -- 型はdim_postsの列定義に合わせて変換する
+    from jsonb_populate_recordset(null::dim_posts, updates) as u
+    where d.post_id = u.post_id
+    returning 1
+  )
+  select count(*)::integer from updated;
+$$;
@@ -0,0 +1,24 @@
+"""
+ServerlessFramework/配下の関数で共有するランタイム（Lambdaレイヤーとして配布する）
+
+ローカルで実行する場合は ServerlessFramework/layers/hpe_runtime/python をPYTHONPATHに追加する
+"""
+from hpe_runtime.cache import (
+    get_boto3_client,
+    get_cache_stats,
+    get_client,
+    get_secret,
+    get_supabase_client,
+    invalidate_secret,
+    log_cache_stats,
+)
+
+__all__ = [
+    "get_boto3_client",
+    "get_cache_stats",
+    "get_client",
+    "get_secret",
+    "get_supabase_client",
+    "invalidate_secret",
+    "log_cache_stats",
+]
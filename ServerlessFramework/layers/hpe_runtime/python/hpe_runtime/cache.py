@@ -0,0 +1,106 @@
+"""
+ウォームスタート間で使い回すシークレットとクライアントのキャッシュ
+
+- シークレットはTTL付きでプロセス内に保持する（HPE_SECRET_TTL_SECONDSで変更できる。デフォルトは300秒）
+- クライアントはキーごとにプロセス内で1つだけ作成する。認証情報をキーに含めておけば、
+  シークレットが更新されたときには新しいクライアントが作られる
+- クライアントの作成中はそのキーだけをロックし、他のキャッシュの参照は止めない
+- ヒット・ミスの回数をget_cache_statsで取得できる
+"""
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple, TypeVar
+
+import boto3
+
+
+T = TypeVar("T")
+
+DEFAULT_SECRET_TTL_SECONDS = float(os.getenv("HPE_SECRET_TTL_SECONDS", "300"))
+
+# 辞書の読み書きだけを保護する。クライアントの作成はキーごとのロック（_client_locks）で行う
+_lock = threading.Lock()
+_secrets: Dict[Tuple[str, Optional[str]], Tuple[float, Dict[str, Any]]] = {}
+_clients: Dict[Hashable, Any] = {}
+_client_locks: Dict[Hashable, threading.Lock] = {}
+_stats: Dict[str, Dict[str, int]] = {
+    "secret": {"hits": 0, "misses": 0},
+    "client": {"hits": 0, "misses": 0},
+}
+
+
+def get_client(key: Hashable, factory: Callable[[], T]) -> T:
+    with _lock:
+        if key in _clients:
+            _stats["client"]["hits"] += 1
+            return _clients[key]
+        key_lock = _client_locks.setdefault(key, threading.Lock())
+    # 同じキーのクライアントは1つだけ作る。作成に時間がかかっても、他のキーの参照は待たせない
+    with key_lock:
+        with _lock:
+            if key in _clients:
+                _stats["client"]["hits"] += 1
+                return _clients[key]
+            _stats["client"]["misses"] += 1
+        client = factory()
+        with _lock:
+            _clients[key] = client
+        return client
+
+
+def get_boto3_client(service_name: str, region_name: Optional[str] = None):
+    return get_client(
+        ("boto3", service_name, region_name),
+        lambda: boto3.client(service_name, region_name=region_name),
+    )
+
+
+def get_secret(secret_id: str, ttl_seconds: Optional[float] = None, region_name: Optional[str] = None) -> Dict[str, Any]:
+    key = (secret_id, region_name)
+    now = time.monotonic()
+    with _lock:
+        cached = _secrets.get(key)
+        if cached is not None and cached[0] > now:
+            _stats["secret"]["hits"] += 1
+            return cached[1]
+        _stats["secret"]["misses"] += 1
+
+    response = get_boto3_client("secretsmanager", region_name).get_secret_value(SecretId=secret_id)
+    secret = json.loads(response["SecretString"])
+    ttl = DEFAULT_SECRET_TTL_SECONDS if ttl_seconds is None else ttl_seconds
+    with _lock:
+        _secrets[key] = (now + ttl, secret)
+    return secret
+
+
+def invalidate_secret(secret_id: str, region_name: Optional[str] = None) -> None:
+    # 認証エラーなどでシークレットが古いとわかった場合に呼ぶ
+    with _lock:
+        _secrets.pop((secret_id, region_name), None)
+
+
+def get_supabase_client(secrets: Dict[str, Any]):
+    from supabase import create_client
+
+    return get_client(
+        ("supabase", secrets["SUPABASE_URL"], secrets["SUPABASE_SERVICE_ROLE_KEY"]),
+        lambda: create_client(secrets["SUPABASE_URL"], secrets["SUPABASE_SERVICE_ROLE_KEY"]),
+    )
+
+
+def get_cache_stats() -> Dict[str, Dict[str, int]]:
+    with _lock:
+        return {name: dict(counts) for name, counts in _stats.items()}
+
+
+def log_cache_stats(logger: logging.Logger) -> None:
+    stats = get_cache_stats()
+    logger.info(
+        "cache stats: secret hits={} misses={}, client hits={} misses={}".format(
+            stats["secret"]["hits"], stats["secret"]["misses"],
+            stats["client"]["hits"], stats["client"]["misses"],
+        )
+    )
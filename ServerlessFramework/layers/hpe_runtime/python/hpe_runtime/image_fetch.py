@@ -0,0 +1,118 @@
+"""
+SNSへ投稿するOG画像の取得
+
+- og_urlがS3のURLであれば、バケットとキーを取り出してget_objectで直接読む
+- それ以外（またはS3から読めない場合）は、コネクションを使い回すurllib3のPoolManagerで取得する
+- 取得した画像はプロセス内の小さなLRUに保持し、同じ記事の再投稿ではダウンロードしない
+- /tmpには書き出さず、bytes（または名前付きのBytesIO）で返す
+"""
+import io
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Final, Optional, Tuple
+from urllib.parse import unquote, urlparse
+
+import urllib3
+from botocore.exceptions import BotoCoreError, ClientError
+
+from hpe_runtime.cache import get_boto3_client, get_client
+
+
+MAX_CACHED_IMAGES: Final[int] = 8
+# OG画像は内容が変わると同じキーで上書きされるため、長くは保持しない
+CACHE_TTL_SECONDS: Final[float] = 600.0
+HTTP_TIMEOUT: Final[urllib3.Timeout] = urllib3.Timeout(connect=5.0, read=30.0)
+# <bucket>.s3.amazonaws.com / <bucket>.s3-<region>.amazonaws.com / <bucket>.s3.<region>.amazonaws.com
+VIRTUAL_HOSTED_PATTERN: Final[re.Pattern] = re.compile(r"^(?P<bucket>.+)\.s3(?:[.-](?P<region>[a-z0-9-]+))?\.amazonaws\.com$")
+# s3.amazonaws.com/<bucket>/<key> / s3-<region>.amazonaws.com/... / s3.<region>.amazonaws.com/...
+PATH_STYLE_PATTERN: Final[re.Pattern] = re.compile(r"^s3(?:[.-](?P<region>[a-z0-9-]+))?\.amazonaws\.com$")
+
+_lock = threading.Lock()
+_images: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+_stats = {"hits": 0, "s3": 0, "http": 0}
+
+
+def parse_s3_url(url: str) -> Optional[Tuple[str, str, Optional[str]]]:
+    # (バケット, キー, リージョン)。S3のURLでなければNone
+    parsed = urlparse(url)
+    host = parsed.hostname or ""
+    path = unquote(parsed.path.lstrip("/"))
+    match = VIRTUAL_HOSTED_PATTERN.match(host)
+    if match and path:
+        return match.group("bucket"), path, match.group("region")
+    match = PATH_STYLE_PATTERN.match(host)
+    if match and "/" in path:
+        bucket, key = path.split("/", 1)
+        return bucket, key, match.group("region")
+    return None
+
+
+def get_pool_manager() -> urllib3.PoolManager:
+    return get_client("urllib3.PoolManager", lambda: urllib3.PoolManager(
+        num_pools=4,
+        maxsize=8,
+        timeout=HTTP_TIMEOUT,
+        retries=urllib3.Retry(total=3, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504]),
+    ))
+
+
+def _fetch_from_s3(bucket: str, key: str, region: Optional[str]) -> Optional[bytes]:
+    try:
+        response = get_boto3_client("s3", region).get_object(Bucket=bucket, Key=key)
+        return response["Body"].read()
+    except (ClientError, BotoCoreError):
+        # 実行ロールに読み取り権限がない場合などは、公開URLから取得する
+        return None
+
+
+def _fetch_over_http(url: str) -> bytes:
+    response = get_pool_manager().request("GET", url)
+    if response.status >= 400:
+        raise RuntimeError(f"Failed to fetch {url}: HTTP {response.status}")
+    return response.data
+
+
+def fetch_image(url: str) -> bytes:
+    now = time.monotonic()
+    with _lock:
+        cached = _images.get(url)
+        if cached is not None and cached[0] > now:
+            _images.move_to_end(url)
+            _stats["hits"] += 1
+            return cached[1]
+
+    image_bytes = None
+    s3_location = parse_s3_url(url)
+    if s3_location is not None:
+        image_bytes = _fetch_from_s3(*s3_location)
+    if image_bytes is None:
+        image_bytes = _fetch_over_http(url)
+        source = "http"
+    else:
+        source = "s3"
+
+    with _lock:
+        _stats[source] += 1
+        _images[url] = (now + CACHE_TTL_SECONDS, image_bytes)
+        _images.move_to_end(url)
+        while len(_images) > MAX_CACHED_IMAGES:
+            _images.popitem(last=False)
+    return image_bytes
+
+
+def as_file(image_bytes: bytes, name: str = "og_image.jpg") -> io.BytesIO:
+    # アップロード時にファイル名を参照するライブラリ（tweepy・Misskey.py）向けに名前を付ける
+    f = io.BytesIO(image_bytes)
+    f.name = name
+    return f
+
+
+def fetch_image_file(url: str, name: str = "og_image.jpg") -> io.BytesIO:
+    return as_file(fetch_image(url), name)
+
+
+def get_image_fetch_stats():
+    with _lock:
+        return dict(_stats)
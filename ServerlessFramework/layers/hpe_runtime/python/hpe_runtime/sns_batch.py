@@ -0,0 +1,81 @@
+"""
+SNS（またはSNSを購読したSQS）から届いたイベントのレコードをまとめて処理する
+
+- event["Records"]の先頭だけでなく、すべてのレコードを上限付きのスレッドプールで並行して処理する
+- SQS経由のレコードは、bodyに包まれたSNSの通知からMessageを取り出す（raw message deliveryの場合はbodyをそのまま使う）
+- SQSから呼ばれた場合は、レコードごとの成否をbatchItemFailuresの形式で返し、失敗したレコードだけが再試行されるようにする
+  （イベントソースマッピングにReportBatchItemFailuresの指定が必要）。すべてのレコードが失敗した場合は例外を送出する
+- SNSから直接呼ばれた場合は戻り値が使われないため、1件でも失敗すれば例外を送出して再試行させる
+"""
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Final, List, NamedTuple, Optional, Tuple
+
+MAX_WORKERS: Final[int] = 4
+
+logger = logging.getLogger(__name__)
+
+
+class RecordResult(NamedTuple):
+    message_id: str
+    result: Any
+    error: Optional[BaseException]
+
+
+class BatchFailed(Exception):
+    def __init__(self, results: List[RecordResult]):
+        super().__init__(f"{len(results)} records failed: {[repr(r.error) for r in results]}")
+        self.results = results
+
+
+def extract_message(record: Dict[str, Any]) -> Tuple[str, str]:
+    # (再試行の単位になるID, SNSのMessage)
+    if "Sns" in record:
+        return record["Sns"].get("MessageId", ""), record["Sns"]["Message"]
+    if "body" in record:
+        body = record["body"]
+        try:
+            envelope = json.loads(body)
+        except ValueError:
+            return record["messageId"], body
+        if isinstance(envelope, dict) and envelope.get("Type") == "Notification" and "Message" in envelope:
+            return record["messageId"], envelope["Message"]
+        return record["messageId"], body
+    raise ValueError(f"Unknown record source: {sorted(record)}")
+
+
+def _process(record: Dict[str, Any], index: int, handle: Callable[[str], Any]) -> RecordResult:
+    message_id = str(index)
+    try:
+        message_id, message = extract_message(record)
+        return RecordResult(message_id, handle(message), None)
+    except Exception as e:
+        logger.error(f"Failed to process record {message_id}. {e!r}")
+        return RecordResult(message_id, None, e)
+
+
+def process_records(event: Dict[str, Any], handle: Callable[[str], Any], max_workers: int = MAX_WORKERS) -> List[RecordResult]:
+    records = event.get("Records", [])
+    if not records:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(records))) as executor:
+        return list(executor.map(lambda args: _process(args[1], args[0], handle), enumerate(records)))
+
+
+def to_batch_response(results: List[RecordResult]) -> Dict[str, List[Dict[str, str]]]:
+    # SQSのReportBatchItemFailuresの形式
+    return {"batchItemFailures": [{"itemIdentifier": r.message_id} for r in results if r.error is not None]}
+
+
+def raise_for_failures(event: Dict[str, Any], results: List[RecordResult]) -> None:
+    failures = [r for r in results if r.error is not None]
+    from_sns = any("Sns" in record for record in event.get("Records", []))
+    if failures and (from_sns or len(failures) == len(results)):
+        raise BatchFailed(failures)
+
+
+def handle_batch(event: Dict[str, Any], handle: Callable[[str], Any], max_workers: int = MAX_WORKERS) -> Dict[str, List[Dict[str, str]]]:
+    results = process_records(event, handle, max_workers)
+    raise_for_failures(event, results)
+    return to_batch_response(results)
@@ -0,0 +1,23 @@
+"""
+SNSへの投稿処理（PostTweet・PostBluesky・PostActivityPub・PostSocialFanoutで共有する）
+
+各プラットフォームのモジュール（twitter・bluesky・misskey）はそれぞれのライブラリに依存するため、
+ここでは共通のメッセージ処理だけを読み込む。使う側で必要なモジュールを個別にimportする
+"""
+from hpe_runtime.social.common import (
+    SOCIAL_POST_IDS_TOPIC_ARN,
+    SocialPostMessage,
+    create_post_text,
+    parse_message,
+    send_social_post_id,
+    send_social_post_ids,
+)
+
+__all__ = [
+    "SOCIAL_POST_IDS_TOPIC_ARN",
+    "SocialPostMessage",
+    "create_post_text",
+    "parse_message",
+    "send_social_post_id",
+    "send_social_post_ids",
+]
@@ -0,0 +1,135 @@
+"""
+Blueskyへの投稿
+
+ログインのたびに認証の往復とログインのレート制限を消費しないよう、セッションを使い回す
+- ウォームスタートでは、プロセス内にキャッシュしたログイン済みのクライアントをそのまま使う
+- コールドスタートでは、SSMパラメータストア（SecureString）に保存したセッション文字列から復元する
+  （/tmpは新しい実行環境では空になるため使わない。アクセストークンの期限が切れていれば、atprotoがリフレッシュトークンで更新する）
+- セッションが更新されるたびにパラメータへ保存し、復元できない場合だけパスワードでログインする
+- 並行して投稿するスレッドがそれぞれパスワードでログインしないよう、ログインとログインし直しはロックの中で行う
+
+実行ロールには、パラメータ（BLUESKY_SESSION_PARAMETER_PREFIX以下）へのssm:GetParameter・ssm:PutParameterが必要
+"""
+import logging
+import os
+import re
+import threading
+from typing import Any, Dict, Final, Optional
+
+from atproto import Client, models
+from botocore.exceptions import BotoCoreError, ClientError
+
+from hpe_runtime.cache import get_boto3_client, get_client, get_secret
+from hpe_runtime.social.common import TYPE_PREFIX, SocialPostMessage
+
+
+SESSION_PARAMETER_PREFIX: Final[str] = os.getenv("BLUESKY_SESSION_PARAMETER_PREFIX", "/hpe/bluesky-session")
+
+logger = logging.getLogger(__name__)
+_login_lock = threading.Lock()
+
+
+def get_bluesky_credentials() -> Dict[str, Any]:
+    return get_secret("hpe-bluesky-bot-tokens")
+
+
+def get_session_parameter_name(useraddress: str) -> str:
+    # パラメータ名に使えない文字（メールアドレスの@など）は置き換える
+    return f"{SESSION_PARAMETER_PREFIX}/{re.sub(r'[^a-zA-Z0-9_.-]', '_', useraddress)}"
+
+
+def load_session(useraddress: str) -> Optional[str]:
+    try:
+        response = get_boto3_client("ssm").get_parameter(Name=get_session_parameter_name(useraddress), WithDecryption=True)
+    except (ClientError, BotoCoreError) as e:
+        # 初回（ParameterNotFound）や権限がない場合は、パスワードでログインする
+        logger.info(f"Bluesky session is not restored. {e!r}")
+        return None
+    return response["Parameter"]["Value"] or None
+
+
+def save_session(useraddress: str, session_string: str) -> None:
+    # セッションは認証情報なのでSecureStringで保存する。保存に失敗しても投稿は続ける
+    try:
+        get_boto3_client("ssm").put_parameter(
+            Name=get_session_parameter_name(useraddress),
+            Value=session_string,
+            Type="SecureString",
+            Overwrite=True,
+        )
+    except (ClientError, BotoCoreError) as e:
+        logger.warning(f"Failed to save Bluesky session. {e!r}")
+
+
+def get_bluesky_client(useraddress: str) -> Client:
+    def create_client() -> Client:
+        client = Client(base_url='https://bsky.social')
+        # トークンのリフレッシュなどでセッションが変わったら保存し直す
+        client.on_session_change(lambda *args: save_session(useraddress, client.export_session_string()))
+        return client
+
+    return get_client(("bluesky", useraddress), create_client)
+
+
+def login(client: Client, secrets: Dict[str, Any]) -> bool:
+    # セッションを復元できた場合（ログイン済みを含む）はTrue、パスワードでログインした場合はFalseを返す
+    with _login_lock:
+        if getattr(client, "me", None) is not None:
+            return True
+        session_string = load_session(secrets["useraddress"])
+        if session_string:
+            try:
+                client.login(session_string=session_string)
+                return True
+            except Exception as e:
+                logger.warning(f"Failed to restore Bluesky session. Falling back to password login. {e!r}")
+        password_login(client, secrets)
+        return False
+
+
+def relogin(client: Client, secrets: Dict[str, Any], rejected_session: str) -> None:
+    # 拒否されたセッションのままであればパスワードでログインし直す。別のスレッドが先にログインし直していれば何もしない
+    with _login_lock:
+        if client.export_session_string() != rejected_session:
+            return
+        password_login(client, secrets)
+
+
+def password_login(client: Client, secrets: Dict[str, Any]) -> None:
+    client.login(secrets["useraddress"], secrets["password"])
+    save_session(secrets["useraddress"], client.export_session_string())
+
+
+def create_post_text(post_title: str, message_type: str) -> str:
+    # URLはリンクカードで表示するため本文には含めない
+    if message_type not in TYPE_PREFIX:
+        raise ValueError("Unknown message type")
+    return f"【{TYPE_PREFIX[message_type]}】 : {post_title}"
+
+
+def post(message: SocialPostMessage, image_bytes: bytes) -> str:
+    secrets = get_bluesky_credentials()
+    bluesky_client = get_bluesky_client(secrets["useraddress"])
+    restored = login(bluesky_client, secrets)
+    session_string = bluesky_client.export_session_string()
+
+    try:
+        thumbnail = bluesky_client.upload_blob(image_bytes)
+    except Exception as e:
+        # 復元したセッションが失効していた場合は、パスワードでログインし直して1回だけやり直す
+        if not restored:
+            raise
+        logger.warning(f"Bluesky session was rejected. Logging in with password. {e!r}")
+        relogin(bluesky_client, secrets, session_string)
+        thumbnail = bluesky_client.upload_blob(image_bytes)
+
+    embed = models.AppBskyEmbedExternal.Main(
+        external=models.AppBskyEmbedExternal.External(
+            title=message.post_title,
+            uri=message.post_url,
+            thumb=thumbnail.blob,
+            description="",
+        )
+    )
+    post = bluesky_client.send_post(text=create_post_text(message.post_title, message.message_type), embed=embed)
+    return post.uri
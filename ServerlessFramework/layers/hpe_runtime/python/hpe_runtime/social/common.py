@@ -0,0 +1,55 @@
+import json
+from typing import Any, Dict, Final, NamedTuple, Optional, Union
+
+from hpe_runtime.cache import get_boto3_client
+
+
+SOCIAL_POST_IDS_TOPIC_ARN: Final[str] = "arn:aws:sns:ap-northeast-1:662924458234:healthy-person-emulator-socialpostIds"
+TYPE_PREFIX: Final[Dict[str, str]] = {
+    "new": "新規記事",
+    "legendary": "殿堂入り",
+    "random": "ランダム",
+}
+
+
+class SocialPostMessage(NamedTuple):
+    post_title: str
+    post_url: str
+    og_url: str
+    message_type: str
+    # PickRandomArticleのメッセージにはpost_idが含まれない
+    post_id: Optional[int]
+
+
+def parse_message(message: Union[str, Dict[str, Any]]) -> SocialPostMessage:
+    if isinstance(message, str):
+        message = json.loads(message)
+    elif not isinstance(message, dict):
+        raise ValueError("Message type is not str or dict")
+    return SocialPostMessage(
+        post_title=message["post_title"],
+        post_url=message["post_url"],
+        og_url=message["og_url"],
+        message_type=message["message_type"],
+        post_id=message.get("post_id"),
+    )
+
+
+def create_post_text(post_title: str, post_url: str, message_type: str) -> str:
+    if message_type not in TYPE_PREFIX:
+        raise ValueError("Unknown message type")
+    return f"[{TYPE_PREFIX[message_type]}] : {post_title} 健常者エミュレータ事例集\n{post_url}"
+
+
+def send_social_post_id(post_id: Optional[int], social_post_id: str, social_type: str) -> None:
+    send_social_post_ids(post_id, {social_type: social_post_id})
+
+
+def send_social_post_ids(post_id: Optional[int], social_post_ids: Dict[str, str]) -> None:
+    # プラットフォームごとのIDを1つのメッセージにまとめて送る（SaveSNSIdsToDBで1行の更新になる）
+    if post_id is None or not social_post_ids:
+        return
+    get_boto3_client("sns").publish(
+        TopicArn=SOCIAL_POST_IDS_TOPIC_ARN,
+        Message=json.dumps({"post_id": post_id, "social_post_ids": social_post_ids}),
+    )
@@ -0,0 +1,34 @@
+from misskey import Misskey
+
+from hpe_runtime.cache import get_client, get_secret
+from hpe_runtime.image_fetch import as_file
+from hpe_runtime.social.common import SocialPostMessage, create_post_text
+
+
+def get_misskey_secret() -> str:
+    secrets = get_secret("MISSKEY_TOKEN")
+    return secrets["MISSKEY_IO_TOKEN"]
+
+
+def get_misskey_client(misskey_token: str) -> Misskey:
+    return get_client(("misskey", misskey_token), lambda: Misskey('https://misskey.io', i=misskey_token))
+
+
+def upload_image_to_misskey(mk: Misskey, image_bytes: bytes) -> str:
+    data = mk.drive_files_create(as_file(image_bytes))
+    return data["id"]
+
+
+def post_note_to_misskey(post_text: str, uploaded_file_id: str, mk: Misskey) -> str:
+    note = mk.notes_create(
+        text=post_text,
+        file_ids=[uploaded_file_id],
+    )
+    return note["createdNote"]["id"]
+
+
+def post(message: SocialPostMessage, image_bytes: bytes) -> str:
+    mk = get_misskey_client(get_misskey_secret())
+    uploaded_file_id = upload_image_to_misskey(mk, image_bytes)
+    post_text = create_post_text(message.post_title, message.post_url, message.message_type)
+    return post_note_to_misskey(post_text, uploaded_file_id, mk)
@@ -0,0 +1,42 @@
+from typing import Any, Dict, Optional
+
+import tweepy
+
+from hpe_runtime.cache import get_client, get_secret
+from hpe_runtime.image_fetch import as_file
+from hpe_runtime.tweet_scheduler import get_tweet_scheduler
+from hpe_runtime.social.common import SocialPostMessage, create_post_text
+
+
+def get_twitter_credentials() -> Dict[str, Any]:
+    return get_secret("hpe-twitter-bot-tokens")
+
+
+def get_twitter_api(secrets: Dict[str, Any]) -> tweepy.API:
+    # 画像のアップロードはv1.1のAPIでしかできない。ツイートはv2のクライアント（TweetScheduler）で送る
+    consumer_key = secrets["CK"]
+    access_token = secrets["AT"]
+
+    def create_api():
+        auth = tweepy.OAuth1UserHandler(
+            consumer_key=consumer_key,
+            consumer_secret=secrets["CS"],
+            access_token=access_token,
+            access_token_secret=secrets["ATS"],
+        )
+        return tweepy.API(auth)
+
+    return get_client(("tweepy.API", consumer_key, access_token), create_api)
+
+
+def post_tweet(post_text: str, image_bytes: bytes, secrets: Dict[str, Any], deadline: Optional[float] = None) -> str:
+    media = get_twitter_api(secrets).media_upload(
+        filename="og_image.jpg", file=as_file(image_bytes)
+    )  # apiv1とv2を併用している
+    return get_tweet_scheduler(secrets).create_tweet(post_text, deadline, media_ids=[media.media_id])
+
+
+def post(message: SocialPostMessage, image_bytes: bytes, deadline: Optional[float] = None) -> str:
+    # deadlineを渡さないと、レート制限のリセット（数時間後のこともある）まで待ち続ける
+    post_text = create_post_text(message.post_title, message.post_url, message.message_type)
+    return post_tweet(post_text, image_bytes, get_twitter_credentials(), deadline)
@@ -0,0 +1,129 @@
+"""
+レート制限を考慮したツイートの送信（PostTweet・ReportWeeklySummary・ReportLegendaryArticleで共有する）
+
+- tweepy.Clientは認証情報ごとに1つだけ作り、return_type=requests.Responseでレスポンスヘッダーを受け取る
+- x-rate-limit-remaining / x-rate-limit-resetから残りの回数とリセット時刻を記録し、使い切っていればリセットまで待つ
+- 連続して送る場合は最低限の間隔を空ける
+- 429が返った場合はリセット時刻まで待ってやり直す。期限（Lambdaの残り時間）までに送れない場合は諦める
+"""
+import logging
+import threading
+import time
+from typing import Any, Dict, Final, List, NamedTuple, Optional
+
+import requests
+import tweepy
+
+from hpe_runtime.cache import get_client
+
+
+MIN_INTERVAL_SECONDS: Final[float] = 1.0
+MAX_ATTEMPTS: Final[int] = 5
+# Lambdaの終了までに残しておく時間
+DEADLINE_MARGIN_SECONDS: Final[float] = 30.0
+
+logger = logging.getLogger(__name__)
+
+
+class TweetResult(NamedTuple):
+    text: str
+    tweet_id: Optional[str]
+    error: Optional[Exception]
+
+
+class RateLimitDeadlineExceeded(Exception):
+    pass
+
+
+def deadline_from_context(context, margin_seconds: float = DEADLINE_MARGIN_SECONDS) -> Optional[float]:
+    # time.time()基準の期限。contextがなければ（ローカル実行）期限なし
+    if context is None or not hasattr(context, "get_remaining_time_in_millis"):
+        return None
+    return time.time() + context.get_remaining_time_in_millis() / 1000 - margin_seconds
+
+
+class TweetScheduler:
+    def __init__(self, client: tweepy.Client, min_interval: float = MIN_INTERVAL_SECONDS):
+        self.client = client
+        self.min_interval = min_interval
+        self.remaining: Optional[int] = None
+        self.reset_at: Optional[float] = None
+        self._last_sent_at = 0.0
+        self._lock = threading.Lock()
+
+    def _update_rate_limit(self, headers) -> None:
+        remaining = headers.get("x-rate-limit-remaining")
+        reset = headers.get("x-rate-limit-reset")
+        if remaining is not None:
+            self.remaining = int(remaining)
+        if reset is not None:
+            self.reset_at = float(reset)
+
+    def _wait(self, until: float, deadline: Optional[float]) -> None:
+        if deadline is not None and until > deadline:
+            raise RateLimitDeadlineExceeded(
+                f"next tweet can be sent at {time.strftime('%H:%M:%S', time.localtime(until))}, after the deadline"
+            )
+        wait = until - time.time()
+        if wait > 0:
+            logger.info(f"Waiting {wait:.1f}s for the Twitter rate limit")
+            time.sleep(wait)
+
+    def _wait_for_quota(self, deadline: Optional[float]) -> None:
+        now = time.time()
+        if self.remaining == 0 and self.reset_at is not None and self.reset_at > now:
+            self._wait(self.reset_at + 1, deadline)
+            self.remaining = None
+        self._wait(self._last_sent_at + self.min_interval, deadline)
+
+    def create_tweet(self, text: str, deadline: Optional[float] = None, **kwargs: Any) -> str:
+        with self._lock:
+            for attempt in range(1, MAX_ATTEMPTS + 1):
+                self._wait_for_quota(deadline)
+                try:
+                    response: requests.Response = self.client.create_tweet(text=text, **kwargs)
+                except tweepy.TooManyRequests as e:
+                    self._update_rate_limit(e.response.headers)
+                    reset_at = self.reset_at if self.reset_at and self.reset_at > time.time() else time.time() + 60 * attempt
+                    logger.warning(f"Twitter rate limit exceeded (attempt {attempt}). Retrying at reset.")
+                    self._wait(reset_at + 1, deadline)
+                    continue
+                except tweepy.TwitterServerError:
+                    if attempt == MAX_ATTEMPTS:
+                        raise
+                    self._wait(time.time() + 2 ** attempt, deadline)
+                    continue
+                finally:
+                    self._last_sent_at = time.time()
+                self._update_rate_limit(response.headers)
+                return response.json()["data"]["id"]
+        raise RuntimeError(f"Failed to tweet after {MAX_ATTEMPTS} attempts")
+
+    def post_all(self, texts: List[str], deadline: Optional[float] = None) -> List[TweetResult]:
+        # 順番に送り、1件の失敗で残りを止めない
+        results = []
+        for text in texts:
+            try:
+                results.append(TweetResult(text, self.create_tweet(text, deadline), None))
+            except Exception as e:
+                logger.error(f"Failed to tweet: {text!r}. {e!r}")
+                results.append(TweetResult(text, None, e))
+        return results
+
+
+def get_tweet_scheduler(secrets: Dict[str, Any]) -> TweetScheduler:
+    consumer_key = secrets["CK"]
+    consumer_secret = secrets["CS"]
+    access_token = secrets["AT"]
+    access_token_secret = secrets["ATS"]
+    # 残り回数の記録をウォームスタート間で引き継ぐため、スケジューラーごとキャッシュする
+    return get_client(
+        ("tweet_scheduler", consumer_key, access_token),
+        lambda: TweetScheduler(tweepy.Client(
+            consumer_key=consumer_key,
+            consumer_secret=consumer_secret,
+            access_token=access_token,
+            access_token_secret=access_token_secret,
+            return_type=requests.Response,
+        )),
+    )